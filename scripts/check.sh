@@ -28,13 +28,15 @@ box check_health "Llama Server" "http://localhost:8080/health" '"status":"ok"' "
 box check_health "Embed Server" "http://localhost:8000/health" '"status":"ok"' "true" "embed-server"
 
 # 5. Check Redis Worker (Checks if it's registered in Redis)
-echo "Checking Redis Worker..."
-if "$HOME/venv/bin/rq" info --url redis://localhost:6379 | grep -q "snippet_queue"; then
-    echo "✅ Redis worker is healthy."
-else
-    echo "❌ ERROR: Redis worker health check failed!"
-    exit 1
-fi
+echo "Checking Redis Workers..."
+for QUEUE in embed_queue extract_queue load_queue; do
+    if "$HOME/venv/bin/rq" info --url redis://localhost:6379 | grep -q "$QUEUE"; then
+        echo "✅ Redis worker for $QUEUE is healthy."
+    else
+        echo "❌ ERROR: Redis worker health check failed for $QUEUE!"
+        exit 1
+    fi
+done
 
 # 6. Check HTTP Server
 box check_health "HTTP Server" "http://localhost:5000/health" '"status":"ok"' "true" "http-server"
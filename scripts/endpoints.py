@@ -0,0 +1,178 @@
+"""
+Client-side load balancing over llama-server replicas.
+
+Every model role (embedding, rerank, completion) has a pool of replica URLs, set as a
+comma-separated list in EMBEDDING_SERVERS, RERANK_SERVERS or LLAMA_SERVERS. Requests go
+to the healthy replica with the fewest requests in flight. A replica that fails
+EJECT_AFTER_FAILURES times in a row is ejected for EJECT_SECONDS and must pass its
+/health check before it gets traffic again. Requests time out after the role's
+*_TIMEOUT seconds, so a replica that accepts connections but hangs counts as failing.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+
+# Configuration
+SERVERS = {
+    "embedding": os.getenv("EMBEDDING_SERVERS", "http://localhost:8000/embedding"),
+    "rerank": os.getenv("RERANK_SERVERS", "http://localhost:8008/rerank"),
+    "completion": os.getenv("LLAMA_SERVERS", "http://localhost:8080/completion"),
+}
+TIMEOUTS = {
+    "embedding": float(os.getenv("EMBEDDING_TIMEOUT", "60")),
+    "rerank": float(os.getenv("RERANK_TIMEOUT", "60")),
+    "completion": float(os.getenv("LLAMA_TIMEOUT", "300")),
+}
+EJECT_AFTER_FAILURES = int(os.getenv("EJECT_AFTER_FAILURES", "3"))
+EJECT_SECONDS = float(os.getenv("EJECT_SECONDS", "30"))
+HEALTH_TIMEOUT = 2
+LATENCY_WINDOW = 1000  # Recent successful requests kept per replica for latency percentiles
+
+_pools = {}
+
+def get_pool(role, urls=None):
+    """
+    The endpoint pool for a model role, built on first use from `urls` or, for the
+    built-in roles, from their *_SERVERS setting.
+    """
+    if role not in _pools:
+        configure_pool(role, urls if urls is not None else SERVERS[role].split(","))
+    return _pools[role]
+
+def configure_pool(role, urls, timeout=None):
+    """Replace a role's replicas, e.g. to point it at local stub servers."""
+    _pools[role] = EndpointPool(role, urls, timeout)
+    return _pools[role]
+
+class Replica:
+    def __init__(self, url):
+        self.url = url.strip()
+        parts = urlsplit(self.url)
+        self.health_url = f"{parts.scheme}://{parts.netloc}/health"
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def stats(self):
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            "url": self.url,
+            "healthy": self.ejected_until == 0,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "latency_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "latency_p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        }
+
+class EndpointPool:
+    """
+    A set of interchangeable replicas for one model role. Requests use `timeout` seconds
+    unless the caller passes its own; the default comes from TIMEOUTS, where versioned
+    roles such as "embedding:<version>" share their base role's setting.
+    """
+
+    def __init__(self, role, urls, timeout=None):
+        self.role = role
+        self.replicas = [Replica(url) for url in urls if url.strip()]
+        self.timeout = timeout or TIMEOUTS.get(role.partition(":")[0], TIMEOUTS["embedding"])
+        self._lock = threading.Lock()
+
+    def _readmit_due(self):
+        """Probe ejected replicas whose time is up; they are re-admitted only if /health says so."""
+        now = time.time()
+        with self._lock:
+            due = [r for r in self.replicas if 0 < r.ejected_until <= now]
+        for replica in due:
+            self.check_health(replica)
+
+    def _acquire(self, tried, fail_open):
+        """
+        Pick the best replica not tried yet and count the request against it under one
+        lock, so concurrent requests see each other: admitted replicas by fewest in
+        flight, then lowest median latency. With `fail_open` (everything is down),
+        ejected replicas are tried in the order they should recover. None when exhausted.
+        """
+        with self._lock:
+            if fail_open:
+                candidates = sorted((r for r in self.replicas if r not in tried), key=lambda r: r.ejected_until)
+            else:
+                candidates = sorted(
+                    (r for r in self.replicas if r.ejected_until == 0 and r not in tried),
+                    key=lambda r: (r.outstanding, np.median(r.latencies) if r.latencies else 0),
+                )
+            if not candidates:
+                return None
+            candidates[0].outstanding += 1
+            return candidates[0]
+
+    def check_health(self, replica):
+        """Probe a replica's /health; re-admit it if it is up, otherwise keep it ejected."""
+        try:
+            healthy = requests.get(replica.health_url, timeout=HEALTH_TIMEOUT).status_code == 200
+        except requests.RequestException:
+            healthy = False
+        with self._lock:
+            if healthy:
+                replica.ejected_until = 0.0
+                replica.consecutive_failures = 0
+                print(f"Re-admitted {self.role} replica {replica.url}.")
+            else:
+                replica.ejected_until = time.time() + EJECT_SECONDS
+        return healthy
+
+    def _record(self, replica, started, failed):
+        with self._lock:
+            replica.outstanding -= 1
+            replica.requests += 1
+            if not failed:
+                replica.latencies.append((time.perf_counter() - started) * 1000)
+                replica.consecutive_failures = 0
+                return
+            replica.errors += 1
+            replica.consecutive_failures += 1
+            if replica.consecutive_failures >= EJECT_AFTER_FAILURES and replica.ejected_until == 0:
+                replica.ejected_until = time.time() + EJECT_SECONDS
+                print(f"Ejected {self.role} replica {replica.url} for {EJECT_SECONDS}s.")
+
+    def post(self, **kwargs):
+        """
+        POST to the best replica, moving on to the next one on connection errors,
+        timeouts or 5xx responses. Returns the response like requests.post; if every
+        replica fails, the last error is raised (or the last 5xx response returned).
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        self._readmit_due()
+        with self._lock:
+            fail_open = not any(r.ejected_until == 0 for r in self.replicas)
+        error = None
+        response = None
+        tried = set()
+        while (replica := self._acquire(tried, fail_open)) is not None:
+            tried.add(replica)
+            started = time.perf_counter()
+            try:
+                response = requests.post(replica.url, **kwargs)
+            except requests.RequestException as e:
+                self._record(replica, started, failed=True)
+                error = e
+                continue
+            failed = response.status_code >= 500
+            self._record(replica, started, failed)
+            if not failed:
+                return response
+        if response is not None:
+            return response
+        raise error or requests.ConnectionError(f"No {self.role} replicas configured")
+
+    def stats(self):
+        return [replica.stats() for replica in self.replicas]
@@ -0,0 +1,294 @@
+"""
+Retrieval-quality vs. speed harness for vector_idx.
+
+Exports the stored embeddings of the active embedding version, computes exact nearest
+neighbours with NumPy as ground truth, then builds a temporary HNSW index for every
+(M, EF_CONSTRUCTION) pair and sweeps EF_RUNTIME, k and rerank depth against it. Reports
+recall@k, nDCG@k after reranking and per-query latency for each configuration.
+
+nDCG needs relevance judgements to reward a reranker that beats vector distance. With
+--judgments (JSON lines {"query": "...", "relevant": {"doc:...": grade, ...}}) it is
+reported as ndcg_at_k; without, the exact-KNN order stands in and the metric is
+reported as knn_ndcg_at_k, i.e. agreement with exact KNN.
+
+    python evaluate.py --queries 200 --m 8,16,32 --ef-runtime 10,50,200 --stub-reranker
+"""
+
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from redis.commands.search.field import VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+
+from endpoints import get_pool, configure_pool
+from helper import get_redis, decode_redis_data, embed_queries, get_active_version
+from vector_store import get_vector_backend, squared_l2, RedisVectorBackend
+
+EVAL_INDEX_PREFIX = "eval_idx"
+
+def parse_ints(value):
+    return [int(v) for v in value.split(",") if v]
+
+def export_embeddings(backend):
+    """Read every hot document's embedding (from `backend`) and snippet out of Redis."""
+    keys = [key.decode("utf-8") for key in get_redis().scan_iter(match="doc:*", count=1000)]
+    vectors_by_key = backend.get(keys)
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        pipe.hget(key, "snippet")
+
+    ids, vectors, texts = [], [], []
+    for key, snippet in zip(keys, pipe.execute()):
+        if key not in vectors_by_key:
+            continue
+        ids.append(key)
+        vectors.append(vectors_by_key[key])
+        texts.append(decode_redis_data({"snippet": snippet or b""})["snippet"])
+
+    matrix = np.vstack(vectors) if vectors else np.empty((0, backend.dim), dtype=np.float32)
+    return ids, matrix, texts
+
+def exact_knn(queries, matrix, k, exclude=None):
+    """
+    Exact L2 nearest neighbours for every query, as row indices into `matrix`, nearest first.
+    `exclude` optionally gives, per query, a row to leave out (the query's own document).
+    """
+    distances = squared_l2(queries, matrix)
+    if exclude is not None:
+        distances[np.arange(len(queries)), exclude] = np.inf
+
+    k = min(k, matrix.shape[0] - (exclude is not None))
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(distances, top, axis=1).argsort(axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+def create_eval_index(backend, m, ef_construction):
+    """Build a temporary HNSW index over the backend's field of doc:* and wait until it has indexed everything."""
+    name = f"{EVAL_INDEX_PREFIX}_m{m}_ef{ef_construction}"
+    try:
+        get_redis().ft(name).dropindex(delete_documents=False)
+    except Exception:
+        pass
+
+    schema = (
+        VectorField(backend.field, "HNSW", {
+            "TYPE": "FLOAT32",
+            "DIM": backend.dim,
+            "DISTANCE_METRIC": "L2",
+            "M": m,
+            "EF_CONSTRUCTION": ef_construction
+        }),
+    )
+    started = time.perf_counter()
+    get_redis().ft(name).create_index(schema, definition=IndexDefinition(prefix=["doc:"], index_type=IndexType.HASH))
+    while not RedisVectorBackend(name, backend.field, backend.dim).indexing_done():
+        time.sleep(0.2)
+    return name, time.perf_counter() - started
+
+def index_search(index_name, field, query_vector, k, ef_runtime):
+    """KNN search against an evaluation index; returns doc keys nearest first."""
+    query = (
+        Query(f"*=>[KNN {k} @{field} $vec EF_RUNTIME {ef_runtime} AS score]")
+        .sort_by("score", asc=True)
+        .return_fields("score")
+        .paging(0, k)
+        .dialect(2)
+    )
+    results = get_redis().ft(index_name).search(query, query_params={"vec": query_vector.tobytes()})
+    return [doc.id for doc in results.docs]
+
+def rerank(query_text, doc_texts):
+    """Relevance scores from the rerank server, in the order of `doc_texts`."""
+    response = get_pool("rerank").post(json={"query": query_text, "documents": doc_texts})
+    response.raise_for_status()
+    scores = [float("-inf")] * len(doc_texts)
+    for result in response.json().get("results", []):
+        scores[result["index"]] = result["relevance_score"]
+    return scores
+
+def knn_gains(truth_ids):
+    """Graded relevance derived from exact KNN: the i-th exact neighbour is worth (len(truth) - i)."""
+    return {doc_id: len(truth_ids) - i for i, doc_id in enumerate(truth_ids)}
+
+def ndcg(ranked_ids, gains, k):
+    """nDCG@k of a ranking against graded relevance `gains` ({doc_id: grade})."""
+    dcg = sum(gains.get(doc_id, 0) / np.log2(rank + 2) for rank, doc_id in enumerate(ranked_ids[:k]))
+    ideal = sum(gain / np.log2(rank + 2) for rank, gain in enumerate(sorted(gains.values(), reverse=True)[:k]))
+    return dcg / ideal if ideal else 0.0
+
+def read_judgments(path, limit):
+    """Query texts and their {doc_id: grade} judgements from a JSON-lines file."""
+    query_texts, judgments = [], []
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                query_texts.append(row["query"])
+                judgments.append({doc_id: float(grade) for doc_id, grade in row["relevant"].items()})
+    return query_texts[:limit], judgments[:limit]
+
+class StubRerankHandler(BaseHTTPRequestHandler):
+    """llama-server compatible /rerank that scores documents by word overlap with the query."""
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        query_words = set(re.findall(r"\w+", payload["query"].lower()))
+        results = []
+        for index, document in enumerate(payload["documents"]):
+            doc_words = set(re.findall(r"\w+", document.lower()))
+            union = query_words | doc_words
+            results.append({"index": index, "relevance_score": len(query_words & doc_words) / len(union) if union else 0.0})
+
+        body = json.dumps({"results": results}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_reranker():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRerankHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/rerank"
+
+def evaluate(args):
+    version = get_active_version()
+    backend = get_vector_backend(version)
+    if not isinstance(backend, RedisVectorBackend):
+        print("The HNSW sweep needs VECTOR_BACKEND=redis.")
+        return []
+    ids, matrix, texts = export_embeddings(backend)
+    if len(ids) < 2:
+        print("Not enough documents in Redis to evaluate.")
+        return []
+    print(f"Exported {len(ids)} embeddings of version '{version}'.")
+
+    # Queries: judged queries, real query texts, or stored documents standing in for queries
+    judgments = None
+    if args.judgments:
+        query_texts, judgments = read_judgments(args.judgments, args.queries)
+        query_vectors = np.vstack(embed_queries(query_texts, version))
+        exclude = None
+    elif args.query_file:
+        with open(args.query_file) as f:
+            query_texts = [line.strip() for line in f if line.strip()][:args.queries]
+        query_vectors = np.vstack(embed_queries(query_texts, version))
+        exclude = None
+    else:
+        rows = random.Random(args.seed).sample(range(len(ids)), min(args.queries, len(ids)))
+        query_texts = [texts[row] for row in rows]
+        query_vectors = matrix[rows]
+        exclude = np.array(rows)
+
+    max_k = max(args.k)
+    started = time.perf_counter()
+    truth = exact_knn(query_vectors, matrix, max_k, exclude)
+    print(f"Exact KNN for {len(query_texts)} queries took {time.perf_counter() - started:.3f}s.")
+    truth_ids = [[ids[row] for row in rows] for rows in truth]
+    id_to_text = dict(zip(ids, texts))
+
+    ndcg_key = "ndcg_at_k" if judgments else "knn_ndcg_at_k"
+    report = []
+    for m, ef_construction in itertools.product(args.m, args.ef_construction):
+        index_name, build_seconds = create_eval_index(backend, m, ef_construction)
+        print(f"Built {index_name} in {build_seconds:.1f}s.")
+        try:
+            for ef_runtime, k, depth in itertools.product(args.ef_runtime, args.k, args.rerank_depth):
+                depth = max(depth, k)
+                recalls, ndcgs, search_ms, rerank_ms = [], [], [], []
+                for q, (query_text, query_vector) in enumerate(zip(query_texts, query_vectors)):
+                    query_truth = truth_ids[q][:k]
+                    exclude_id = ids[exclude[q]] if exclude is not None else None
+
+                    t0 = time.perf_counter()
+                    candidates = index_search(index_name, backend.field, query_vector, depth + (exclude is not None), ef_runtime)
+                    search_ms.append((time.perf_counter() - t0) * 1000)
+                    candidates = [doc_id for doc_id in candidates if doc_id != exclude_id][:depth]
+
+                    recalls.append(len(set(candidates[:k]) & set(query_truth)) / len(query_truth))
+
+                    t0 = time.perf_counter()
+                    scores = rerank(query_text, [id_to_text.get(doc_id, "") for doc_id in candidates])
+                    rerank_ms.append((time.perf_counter() - t0) * 1000)
+                    reranked = [doc_id for _, doc_id in sorted(zip(scores, candidates), key=lambda pair: pair[0], reverse=True)]
+                    ndcgs.append(ndcg(reranked, judgments[q] if judgments else knn_gains(query_truth), k))
+
+                total_ms = np.array(search_ms) + np.array(rerank_ms)
+                row = {
+                    "M": m,
+                    "EF_CONSTRUCTION": ef_construction,
+                    "EF_RUNTIME": ef_runtime,
+                    "k": k,
+                    "rerank_depth": depth,
+                    "build_seconds": round(build_seconds, 2),
+                    "recall_at_k": round(float(np.mean(recalls)), 4),
+                    ndcg_key: round(float(np.mean(ndcgs)), 4),
+                    "search_p50_ms": round(float(np.percentile(search_ms, 50)), 2),
+                    "search_p95_ms": round(float(np.percentile(search_ms, 95)), 2),
+                    "rerank_p50_ms": round(float(np.percentile(rerank_ms, 50)), 2),
+                    "total_p50_ms": round(float(np.percentile(total_ms, 50)), 2),
+                    "total_p95_ms": round(float(np.percentile(total_ms, 95)), 2)
+                }
+                report.append(row)
+                print(" ".join(f"{key}={value}" for key, value in row.items()))
+        finally:
+            get_redis().ft(index_name).dropindex(delete_documents=False)
+
+    return report
+
+def pick_fastest(report, min_recall, min_ndcg):
+    """Fastest configuration (by p95 latency) that meets the quality bar."""
+    passing = [
+        row for row in report
+        if row["recall_at_k"] >= min_recall and row.get("ndcg_at_k", row.get("knn_ndcg_at_k", 0)) >= min_ndcg
+    ]
+    return min(passing, key=lambda row: row["total_p95_ms"]) if passing else None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep vector_idx and query settings against exact-KNN ground truth.")
+    parser.add_argument("--queries", type=int, default=100, help="Number of queries to evaluate")
+    parser.add_argument("--query-file", help="Text file with one query per line (default: sample stored documents)")
+    parser.add_argument("--judgments", help="JSON-lines relevance judgements; their queries are used and nDCG is scored against them")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--m", type=parse_ints, default=[16], help="HNSW M values, comma-separated")
+    parser.add_argument("--ef-construction", type=parse_ints, default=[200], help="HNSW EF_CONSTRUCTION values")
+    parser.add_argument("--ef-runtime", type=parse_ints, default=[10], help="HNSW EF_RUNTIME values")
+    parser.add_argument("--k", type=parse_ints, default=[5], help="k values passed to the KNN query")
+    parser.add_argument("--rerank-depth", type=parse_ints, default=[5], help="Candidates sent to the reranker")
+    parser.add_argument("--stub-reranker", action="store_true", help="Rerank with a local word-overlap stub instead of RERANK_SERVERS")
+    parser.add_argument("--min-recall", type=float, default=0.9)
+    parser.add_argument("--min-ndcg", type=float, default=0.0)
+    parser.add_argument("--output", help="Write the full report as JSON to this file")
+    args = parser.parse_args()
+
+    stub = None
+    if args.stub_reranker:
+        stub, stub_url = start_stub_reranker()
+        configure_pool("rerank", [stub_url])
+
+    try:
+        report = evaluate(args)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+
+        best = pick_fastest(report, args.min_recall, args.min_ndcg)
+        if best:
+            print(f"Fastest configuration meeting the quality bar: {json.dumps(best)}")
+        else:
+            print("No configuration meets the quality bar.")
+    finally:
+        if stub:
+            stub.shutdown()
+        get_redis().close()
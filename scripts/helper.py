@@ -1,27 +1,110 @@
 import gc  # Import garbage collection module
 
+import atexit
+import inspect
 import requests
 import numpy as np
 import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 from redis import Redis
 from redis.commands.search.query import Query
-from neo4j import GraphDatabase
+from rq import Queue
 
-EMBEDDING_SERVER = "http://localhost:8000/embedding"  # Llama-cpp endpoint
-RERANK_SERVER = "http://localhost:8008/rerank"
-LLAMA_SERVER = "http://localhost:8080/completion"
+from endpoints import get_pool
+
+RERANK_PARALLELISM = int(os.getenv("RERANK_PARALLELISM", "4"))  # Concurrent rerank requests for batch queries
 REDIS_HOST = "localhost"
 REDIS_PORT = 6379
 
-# Redis connection (set decode_responses=False to handle binary data properly)
-redis_conn = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=False)
-
 # Neo4j connection
 NEO4J_URI = "bolt://localhost:7687"
-NEO4J_USER = "neo4j"
-NEO4J_PASSWORD = "password"
-driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+NEO4J_USER = os.getenv("NEO4J_USERNAME", "neo4j")
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "password")  # Default password, change as needed
+
+# Connections are created on first use, once per process. A forked RQ work horse sees
+# a different PID and opens its own instead of sharing its parent's sockets.
+_connections = {"pid": None, "redis": None, "driver": None}
+
+def _current_connections():
+    if _connections["pid"] != os.getpid():
+        _connections.update(pid=os.getpid(), redis=None, driver=None)
+    return _connections
+
+def get_redis():
+    """Redis connection for this process (set decode_responses=False to handle binary data properly)."""
+    connections = _current_connections()
+    if connections["redis"] is None:
+        connections["redis"] = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=False)
+    return connections["redis"]
+
+def get_driver():
+    """Neo4j driver for this process."""
+    connections = _current_connections()
+    if connections["driver"] is None:
+        from neo4j import GraphDatabase
+        connections["driver"] = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+    return connections["driver"]
+
+def close_connections():
+    """Close this process's connections; registered to run at interpreter exit."""
+    connections = _current_connections()
+    if connections["redis"] is not None:
+        connections["redis"].close()
+    if connections["driver"] is not None:
+        connections["driver"].close()
+    connections.update(redis=None, driver=None)
+
+atexit.register(close_connections)
+
+# Stage-separated queues. Each ingest stage has its own queue and its own worker
+# pool (see setup.sh), so a slow spaCy extraction never blocks cheap embedding jobs.
+# Fresh captures go to the primary queue; backfill goes to the "_backfill" queue,
+# which the same workers only drain once the primary queue is empty.
+# Past `max_pending` jobs a stage defers new work; past `admit_limit` /snippet stops
+# accepting captures altogether and answers 429.
+STAGES = {
+    "embed": {
+        "queue": "embed_queue",
+        "max_pending": int(os.getenv("EMBED_QUEUE_LIMIT", "200")),
+        "admit_limit": int(os.getenv("EMBED_ADMIT_LIMIT", "400")),
+    },
+    "extract": {
+        "queue": "extract_queue",
+        "max_pending": int(os.getenv("EXTRACT_QUEUE_LIMIT", "500")),
+        "admit_limit": int(os.getenv("EXTRACT_ADMIT_LIMIT", "1000")),
+    },
+    "load": {
+        "queue": "load_queue",
+        "max_pending": int(os.getenv("LOAD_QUEUE_LIMIT", "500")),
+        "admit_limit": int(os.getenv("LOAD_ADMIT_LIMIT", "1000")),
+    },
+}
+BACKFILL_SUFFIX = "_backfill"
+DEFERRED_SUFFIX = "_deferred"  # Holds a stage's release_deferred jobs, apart from its real work
+
+# Per-capture pipeline tracking. Each /snippet capture gets a capture:{id} hash with
+# the start, end and outcome of every stage; progress is published on capture:{id}
+# and terminal events also on CAPTURE_CHANNEL.
+CAPTURE_TTL = int(os.getenv("CAPTURE_TTL", str(7 * 24 * 3600)))
+CAPTURE_CHANNEL = "capture_events"
+TERMINAL_STATUSES = ("indexed", "failed")
+BACKPRESSURE_DELAY = int(os.getenv("BACKPRESSURE_DELAY", "30"))  # Seconds to defer a job when its stage is full
+
+# Embedding model versions. Vectors are kept per version (their own field and index, or
+# directory for the embedded backend). Reads use the active version; while reembed.py
+# builds a new one, new documents are embedded with both. Versions other than the
+# default are registered in EMBEDDING_VERSIONS_KEY with their dimension and servers.
+DEFAULT_EMBEDDING_VERSION = os.getenv("EMBEDDING_VERSION", "nomic-embed-v1.5")  # Model behind EMBEDDING_SERVERS
+DEFAULT_EMBEDDING_DIM = 768
+ACTIVE_VERSION_KEY = "embedding:active_version"
+BUILDING_VERSION_KEY = "embedding:building_version"
+EMBEDDING_VERSIONS_KEY = "embedding:versions"
+VERSION_CACHE_SECONDS = 5  # How long a process may keep serving a version after a switch
+_version_cache = {"expires": 0, "active": None, "building": None}
 
 def decode_redis_data(doc_data):
     """Decode Redis data, handling binary and UTF-8 strings."""
@@ -35,67 +118,336 @@ def decode_redis_data(doc_data):
         decoded_data[key_decoded] = value_decoded
     return decoded_data
 
-def store_document_in_redis(doc_id, item, embedding_bytes):
-    """Store document and embedding in Redis."""
+def store_document_in_redis(doc_id, item, embedding_bytes, version=None):
+    """Store document in Redis and its embedding, made with model `version`, in the vector backend."""
+    from vector_store import get_vector_backend
+
+    version = version or get_active_version()
     mapping = {k: str(v) for k, v in item.items() if k != "embedding"}
-    redis_conn.hset(f"doc:{doc_id}", mapping=mapping)
-    redis_conn.hset(f"doc:{doc_id}", "embedding", embedding_bytes)
+    mapping["last_access"] = str(time.time())  # Used by tiering.py to pick cold documents
+    mapping["embedding_version"] = version
+    get_redis().hset(f"doc:{doc_id}", mapping=mapping)
+    get_vector_backend(version).add([(f"doc:{doc_id}", np.frombuffer(embedding_bytes, dtype=np.float32))])
     print(f"Added document with UUID: {doc_id}")
 
+def _refresh_versions():
+    if time.time() >= _version_cache["expires"]:
+        active, building = get_redis().mget(ACTIVE_VERSION_KEY, BUILDING_VERSION_KEY)
+        _version_cache.update(
+            expires=time.time() + VERSION_CACHE_SECONDS,
+            active=active.decode("utf-8") if active else DEFAULT_EMBEDDING_VERSION,
+            building=building.decode("utf-8") if building else None,
+        )
+    return _version_cache
+
+def get_active_version():
+    """Embedding version that searches read from."""
+    return _refresh_versions()["active"]
+
+def get_building_version():
+    """Embedding version being built by reembed.py, or None."""
+    return _refresh_versions()["building"]
+
+def get_embedding_version(version):
+    """Settings of an embedding version: {"dim": ..., "servers": [...] or None for EMBEDDING_SERVERS}."""
+    if version == DEFAULT_EMBEDDING_VERSION:
+        return {"dim": DEFAULT_EMBEDDING_DIM, "servers": None}
+    spec = get_redis().hget(EMBEDDING_VERSIONS_KEY, version)
+    if spec is None:
+        raise KeyError(f"Unknown embedding version '{version}'")
+    return json.loads(spec)
+
+def register_embedding_version(version, dim, servers):
+    get_redis().hset(EMBEDDING_VERSIONS_KEY, version, json.dumps({"dim": dim, "servers": servers}))
+
+def get_embedding_pool(version):
+    """Endpoint pool of the embedding servers that produce `version`."""
+    servers = get_embedding_version(version)["servers"]
+    return get_pool("embedding") if servers is None else get_pool(f"embedding:{version}", servers)
+
+def parse_embeddings(response):
+    """One float32 vector per input, in input order, from a llama-server /embedding response."""
+    vectors = []
+    for item in sorted(response.json(), key=lambda item: item.get("index", 0)):
+        vector = np.asarray(item["embedding"], dtype=np.float32)
+        vectors.append(vector[0] if vector.ndim > 1 else vector)
+    return vectors
+
+def embed_texts(texts, version):
+    """Embed texts with the model of `version` in a single request."""
+    response = get_embedding_pool(version).post(json={"content": list(texts)})
+    response.raise_for_status()
+    return parse_embeddings(response)
+
+def store_building_vectors(keys, texts):
+    """
+    While a new embedding version is being built, embed new documents with it too so
+    the re-embedding job does not have to chase them. Failures are left to that job.
+    """
+    from vector_store import get_vector_backend
+
+    version = get_building_version()
+    if not version or not keys:
+        return
+    try:
+        get_vector_backend(version).add(zip(keys, embed_texts(texts, version)))
+    except Exception as e:
+        print(f"Could not embed {len(keys)} documents with version '{version}' yet: {e}")
+
+def get_stage_queue(stage, backfill=False):
+    """Return the RQ queue for an ingest stage ("embed", "extract" or "load")."""
+    name = STAGES[stage]["queue"]
+    if backfill:
+        name += BACKFILL_SUFFIX
+    return Queue(name, connection=get_redis())
+
+def get_deferred_queue(stage):
+    """Return the queue of a stage's release_deferred jobs, served by the stage's workers."""
+    return Queue(STAGES[stage]["queue"] + DEFERRED_SUFFIX, connection=get_redis())
+
+def stage_pending(stage):
+    """
+    Number of jobs waiting in a stage, across its fresh and backfill queues, including
+    jobs waiting for a retry in their scheduled registries.
+    """
+    pending = 0
+    for backfill in (False, True):
+        queue = get_stage_queue(stage, backfill)
+        pending += len(queue) + queue.scheduled_job_registry.count
+    return pending
+
+def stage_deferred(stage):
+    """Number of a stage's jobs deferred by backpressure and not yet released."""
+    queue = get_deferred_queue(stage)
+    return len(queue) + queue.scheduled_job_registry.count
+
+def enqueue_stage(stage, func, args=(), kwargs=None, backfill=False, **job_options):
+    """
+    Enqueue a job on the given stage's queue.
+
+    The job's own arguments are passed as `args`/`kwargs`; `backfill` picks the queue and
+    is also forwarded to `func` if it takes a `backfill` argument, so every later stage
+    of a backfill capture stays on the backfill queues. Other keywords are RQ job options.
+
+    If the stage already holds its configured `max_pending` jobs, a release_deferred
+    job is scheduled BACKPRESSURE_DELAY seconds later instead, which checks the limit
+    again before enqueueing the real job, so an upstream stage cannot flood a slower
+    downstream one. Release jobs live on the stage's own deferred queue and do not
+    count towards `max_pending`, so however many are waiting, they drain as the stage
+    does. Deferred jobs require workers started with `--with-scheduler`.
+    """
+    kwargs = dict(kwargs or {})
+    if "backfill" in inspect.signature(func).parameters:
+        kwargs["backfill"] = backfill
+    if stage_pending(stage) >= STAGES[stage]["max_pending"]:
+        print(f"Stage '{stage}' is full, deferring job by {BACKPRESSURE_DELAY}s.")
+        return get_deferred_queue(stage).enqueue_in(timedelta(seconds=BACKPRESSURE_DELAY), release_deferred,
+                                                    stage, func, args, kwargs, backfill, job_options)
+    return get_stage_queue(stage, backfill).enqueue(func, args=args, kwargs=kwargs, **job_options)
+
+def release_deferred(stage, func, args, kwargs, backfill, job_options):
+    """Run when a deferred job's delay is over: enqueue it, or defer it again if the stage is still full."""
+    return enqueue_stage(stage, func, args, kwargs, backfill=backfill, **job_options).id
+
+def overloaded_stage():
+    """First stage whose pending and deferred jobs reached its admission limit, or None if all have room."""
+    for stage, config in STAGES.items():
+        if stage_pending(stage) + stage_deferred(stage) >= config["admit_limit"]:
+            return stage
+    return None
+
+def is_terminal_event(event):
+    """
+    Whether a capture event reports the capture's final status. Stage transitions carry
+    "stage" and "stage_status" instead, so one document failing a stage is not terminal.
+    """
+    return "stage" not in event and event.get("status") in TERMINAL_STATUSES
+
+def publish_capture_event(capture_id, event):
+    """Notify subscribers of a capture about a stage transition or its final status."""
+    message = json.dumps({"capture_id": capture_id, **event})
+    get_redis().publish(f"capture:{capture_id}", message)
+    if is_terminal_event(event):
+        get_redis().publish(CAPTURE_CHANNEL, message)
+
+def create_capture(capture_id):
+    """Register a new capture as queued, discarding any earlier run of it (e.g. before a replay)."""
+    pipe = get_redis().pipeline()
+    pipe.delete(f"capture:{capture_id}")
+    pipe.hset(f"capture:{capture_id}", mapping={"status": "queued", "queued_at": str(time.time())})
+    pipe.expire(f"capture:{capture_id}", CAPTURE_TTL)
+    pipe.execute()
+
+def track_stage(capture_id, stage, status):
+    """
+    Record a stage transition ("started", "finished" or "failed") for a capture.
+
+    Extract and load run once per document, so a stage keeps its first start time, its
+    latest end time and a count of finished and failed runs.
+    """
+    if not capture_id:
+        return
+    key = f"capture:{capture_id}"
+    now = str(time.time())
+    pipe = get_redis().pipeline()
+    if status == "started":
+        pipe.hsetnx(key, f"{stage}:started_at", now)
+        pipe.hset(key, "status", "running")
+    else:
+        pipe.hset(key, f"{stage}:ended_at", now)
+        pipe.hincrby(key, f"{stage}:{status}", 1)
+    pipe.expire(key, CAPTURE_TTL)
+    pipe.execute()
+    publish_capture_event(capture_id, {"stage": stage, "stage_status": status})
+
+def complete_capture(capture_id, status):
+    """Mark a capture as indexed or failed and notify subscribers."""
+    get_redis().hset(f"capture:{capture_id}", mapping={"status": status, "completed_at": str(time.time())})
+    publish_capture_event(capture_id, {"status": status})
+
+def fail_capture(capture_id, stage):
+    """Record a stage failure that ends the whole capture (e.g. no embeddings at all)."""
+    if not capture_id:
+        return
+    track_stage(capture_id, stage, "failed")
+    complete_capture(capture_id, "failed")
+
+def set_capture_documents(capture_id, count):
+    """Record how many documents a capture produced. Must be called before their stages are enqueued."""
+    if not capture_id:
+        return
+    get_redis().hset(f"capture:{capture_id}", "documents", count)
+    if count == 0:
+        complete_capture(capture_id, "indexed")
+
+def finish_capture_document(capture_id, failed=False):
+    """
+    Record that one document of a capture reached the end of the pipeline (loaded, or
+    failed at some stage). The capture completes when every document has.
+    """
+    if not capture_id:
+        return
+    key = f"capture:{capture_id}"
+    pipe = get_redis().pipeline()
+    pipe.hincrby(key, "documents_done", 1)
+    pipe.hincrby(key, "documents_failed", 1 if failed else 0)
+    pipe.hget(key, "documents")
+    done, failures, documents = pipe.execute()
+    if documents is not None and done == int(documents):
+        complete_capture(capture_id, "failed" if failures else "indexed")
+
+def get_capture(capture_id):
+    """Return the decoded capture:{id} hash, or None if the capture is unknown or expired."""
+    capture = decode_redis_data(get_redis().hgetall(f"capture:{capture_id}"))
+    return {"capture_id": capture_id, **capture} if capture else None
+
 def save_to_local_file(file_path, data):
     """Save data to a local JSON file."""
     with open(file_path, "a") as f:
         json.dump(data, f)
         f.write("\n")
         
+def embed_queries(query_texts, version=None):
+    """Compute embeddings for a list of query texts with a single request to the embedding server."""
+    return embed_texts(query_texts, version or get_active_version())
+
+def knn_query(k=5, field="embedding"):
+    """KNN Search Query using your "vector_idx"."""
+    return (
+        Query(f"*=>[KNN {k} @{field} $vec AS score]")  # Find k nearest neighbors
+        .sort_by("score", asc=False)  # Sort by similarity score
+        .return_fields("score")  # Retrieve content and score
+        .paging(0, k)  # Return all k neighbours
+        .dialect(2)  # Use dialect 2 for better query parsing
+    )
+
+# HSET that never creates a hash, so a late access update cannot resurrect an archived document
+TOUCH_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+return 0
+"""
+
 def redis_search(query_text, k=5):
     """Search for documents in Redis using the query text."""
+    return redis_search_batch([query_text], k)[0]
+
+def redis_search_batch(query_texts, k=5):
+    """
+    Search for documents in Redis for several query texts at once.
+
+    All queries are embedded in one request, their KNN searches run as one Redis
+    pipeline and the matching documents are fetched with one more. Returns one list
+    of documents per query, in the same order as `query_texts`.
+    """
     try: 
-        # Compute embedding from the query text
-        response = requests.post(EMBEDDING_SERVER, json={"content": [query_text]})
-        if response.status_code != 200:
-            return jsonify({"error": "Failed to compute embedding"}), 500
-
-        query_embedding = np.array(response.json()[0]['embedding'], dtype=np.float32).tobytes()
-
-        # KNN Search Query using your "vector_idx"
-        search_query = (
-            Query(f"*=>[KNN {k} @embedding $vec AS score]")  # Find k nearest neighbors
-            .sort_by("score", asc=False)  # Sort by similarity score
-            .return_fields("score")  # Retrieve content and score
-            .paging(0, 5)  # Limit results
-            .dialect(2)  # Use dialect 2 for better query parsing
-        )
+        # Compute embeddings for all query texts. The version is fixed for the whole
+        # batch so query and document vectors match even if a switch happens meanwhile.
+        version = get_active_version()
+        query_vectors = embed_queries(query_texts, version)
+        if len(query_vectors) != len(query_texts):
+            raise Exception("Failed to compute embedding")
+
+        # Search the hot vector backend for every query at once (one pipeline for Redis)
+        from vector_store import get_vector_backend
+        hot_results = get_vector_backend(version).search_batch(query_vectors, k)
+
+        # Exact scan of the cold tier; its scores are comparable L2 distances
+        from tiering import cold_search_batch, rehydrate_documents
+        cold_results = cold_search_batch(query_vectors, k, version)
+
+        all_hits = []
+        for hot_hits, cold_hits in zip(hot_results, cold_results):
+            hits = [(doc_id, score, None) for doc_id, score in hot_hits]
+            hits += cold_hits
+            hits = sorted(hits, key=lambda hit: hit[1])[:k]
+            hits.sort(key=lambda hit: hit[1], reverse=True)  # Same order as the hot-only search
+            all_hits.append(hits)
+
+        # Fetch each hot document once, even if several queries matched it
+        hot_ids = list({doc_id for hits in all_hits for doc_id, _, cold_row in hits if not cold_row})
+        pipe = get_redis().pipeline(transaction=False)
+        for doc_id in hot_ids:
+            pipe.hgetall(doc_id)
+        hot_docs = dict(zip(hot_ids, pipe.execute()))
 
-        # Perform the search in Redis
-        results = redis_conn.ft("vector_idx").search(search_query, query_params={"vec": query_embedding})
-        
         # Format the results
-        documents = []
-        for doc in results.docs:
-            
-            doc_id = doc.id
-            
-            # get document from doc.id
-            doc_data = redis_conn.hgetall(f"{doc_id}")
-            if doc_data:
-                decoded_doc = decode_redis_data(doc_data)
-                documents.append({
-                    "id": doc_id,
-                    "score": doc.score,
-                    "title": decoded_doc["title"],
-                    "url": decoded_doc["url"],
-                    "date": decoded_doc["date"],
-                    "content": decoded_doc["snippet"],
-                    "relations": json.loads(decoded_doc.get("relations", "{}")),
-                    "named_entities": json.loads(decoded_doc.get("named_entities", "{}"))
-                })
-
-        return documents
+        all_documents = []
+        for hits in all_hits:
+            documents = []
+            for doc_id, score, cold_row in hits:
+                
+                # get document from doc.id (or the archive row for cold hits)
+                doc_data = cold_row or hot_docs.get(doc_id)
+                if doc_data:
+                    decoded_doc = decode_redis_data(doc_data)
+                    documents.append({
+                        "id": doc_id,
+                        "score": score,
+                        "title": decoded_doc["title"],
+                        "url": decoded_doc["url"],
+                        "date": decoded_doc["date"],
+                        "content": decoded_doc["snippet"],
+                        "relations": json.loads(decoded_doc.get("relations", "{}")),
+                        "named_entities": json.loads(decoded_doc.get("named_entities", "{}"))
+                    })
+            all_documents.append(documents)
+
+        # Keep accessed documents hot, and pull accessed cold documents back in
+        # (only if the hash still exists: tiering may have archived it since it was read)
+        touch = get_redis().register_script(TOUCH_IF_EXISTS)
+        pipe = get_redis().pipeline(transaction=False)
+        for doc_id in hot_ids:
+            if hot_docs[doc_id]:
+                touch(keys=[doc_id], args=["last_access", str(time.time())], client=pipe)
+        pipe.execute()
+        rehydrate_documents({doc_id for hits in all_hits for doc_id, _, cold_row in hits if cold_row})
+
+        return all_documents
     except Exception as e:
         raise Exception(f"Failed to perform Redis search: {e}")
     finally:
-        redis_conn.close()
         gc.collect()
 
 def neo4j_enrich(doc_ids):
@@ -120,7 +472,7 @@ def neo4j_enrich(doc_ids):
                TYPE(r) AS relation, other.text AS related_entity, r.confidence AS confidence
     """
     
-    with driver.session() as session:
+    with get_driver().session() as session:
         result = session.run(query, doc_ids=doc_ids)
         entity_relations = {}
         for record in result:
@@ -186,7 +538,7 @@ def rerank_docs(query_text, redis_docs, top_k=3):
     }
 
     try:
-        response = requests.post(RERANK_SERVER, json=payload)
+        response = get_pool("rerank").post(json=payload)
         response.raise_for_status()
         rerank_results = response.json().get("results", [])
 
@@ -204,16 +556,33 @@ def rerank_docs(query_text, redis_docs, top_k=3):
         print(f"Error during reranking: {e}")
         return redis_docs[:top_k]  # Fallback: return top-k from original
 
-def neo4j_search(query_text, k=5):
-    top_docs = redis_search(query_text, k)
-    top_docs = rerank_docs(query_text, top_docs)
+def rerank_docs_batch(query_texts, redis_docs_lists, top_k=3):
+    """Rerank the documents of several queries, sending up to RERANK_PARALLELISM requests at a time."""
+    with ThreadPoolExecutor(max_workers=RERANK_PARALLELISM) as executor:
+        return list(executor.map(lambda args: rerank_docs(*args, top_k=top_k), zip(query_texts, redis_docs_lists)))
+
+def retrieve_batch(query_texts, k=5):
+    """
+    Shared retrieval for batches: Redis KNN, reranking, then a single Neo4j round trip
+    for the union of all doc IDs. Returns (reranked docs per query, Neo4j data by doc ID).
+    """
+    top_docs_lists = rerank_docs_batch(query_texts, redis_search_batch(query_texts, k))
 
     # Extract raw doc IDs (strip "doc:" prefix)
-    doc_id_map = {doc["id"].split(":", 1)[1]: doc for doc in top_docs}
-    doc_ids = list(doc_id_map.keys())
+    doc_ids = list({doc["id"].split(":", 1)[1] for top_docs in top_docs_lists for doc in top_docs})
 
     # Fetch Neo4j data for all doc_ids
-    return neo4j_enrich(doc_ids)
+    return top_docs_lists, neo4j_enrich(doc_ids)
+
+def neo4j_search(query_text, k=5):
+    return neo4j_search_batch([query_text], k)[0]
+
+def neo4j_search_batch(query_texts, k=5):
+    top_docs_lists, neo4j_data = retrieve_batch(query_texts, k)
+    return [
+        {raw_doc_id: neo4j_data[raw_doc_id] for raw_doc_id in (doc["id"].split(":", 1)[1] for doc in top_docs) if raw_doc_id in neo4j_data}
+        for top_docs in top_docs_lists
+    ]
 
 def extract_facts_and_entities(docs, confidence_threshold=0.8, max_facts=5):
     facts = []
@@ -299,9 +668,9 @@ def build_prompt(query, facts, entities, docs, include_content=True):
 
     return "\n".join(lines)
 
-def call_slm(prompt, endpoint=LLAMA_SERVER):
+def call_slm(prompt):
     payload = {"prompt": prompt}
-    response = requests.post(endpoint, json=payload)
+    response = get_pool("completion").post(json=payload)
     response.raise_for_status()
     return response.json() if response.status_code == 200 else None
 
@@ -323,20 +692,32 @@ def context_search(query_text, k=5):
     Fetches relevant documents from Redis and enriches them with Neo4j insights.
     Merges entities, relations, and document metadata from Neo4j.
     """
-    neo4j_data = nsearch(query_text)
-
-    # Merge Neo4j insights with Redis data
-    for raw_doc_id, doc in doc_id_map.items():
-        neo_data = neo4j_data.get(raw_doc_id, {})
-        metadata = neo_data.get("metadata", {})
-
-        # Merge metadata from Neo4j (prefer Redis unless Neo4j has newer info)
-        doc["neo4j_title"] = metadata.get("title", "")
-        doc["neo4j_url"] = metadata.get("url", "")
-        doc["neo4j_date"] = metadata.get("date", "")
-
-        # Add Neo4j entities and relations
-        doc["entities"] = neo_data.get("entities", [])
-        doc["neo4j_relations"] = neo_data.get("relations", [])
- 
-    return generate_answer(query_text, doc_id_map.values())
+    for _, result in context_search_batch([query_text], k):
+        return result
+
+def context_search_batch(query_texts, k=5):
+    """
+    Batch version of context_search. Retrieval is shared across all queries; answers are
+    generated one query at a time and yielded as (query, result) pairs as soon as each
+    completion is ready, so callers can stream them.
+    """
+    top_docs_lists, neo4j_data = retrieve_batch(query_texts, k)
+
+    for query_text, top_docs in zip(query_texts, top_docs_lists):
+        doc_id_map = {doc["id"].split(":", 1)[1]: doc for doc in top_docs}
+
+        # Merge Neo4j insights with Redis data
+        for raw_doc_id, doc in doc_id_map.items():
+            neo_data = neo4j_data.get(raw_doc_id, {})
+            metadata = neo_data.get("metadata", {})
+
+            # Merge metadata from Neo4j (prefer Redis unless Neo4j has newer info)
+            doc["neo4j_title"] = metadata.get("title", "")
+            doc["neo4j_url"] = metadata.get("url", "")
+            doc["neo4j_date"] = metadata.get("date", "")
+
+            # Add Neo4j entities and relations
+            doc["entities"] = neo_data.get("entities", [])
+            doc["neo4j_relations"] = neo_data.get("relations", [])
+
+        yield query_text, generate_answer(query_text, list(doc_id_map.values()))
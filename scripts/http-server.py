@@ -1,50 +1,88 @@
-from flask import Flask, request, jsonify
-from redis import Redis
+from flask import Flask, Response, request, jsonify, stream_with_context
 
-from rq import Queue
 from rq.registry import FailedJobRegistry, StartedJobRegistry, FinishedJobRegistry
 
 import json
 import os
 import psutil
+import threading
+import time
+import uuid
 from datetime import datetime
 
-from worker import embed_snippet 
-from helper import decode_redis_data, redis_search, neo4j_search, context_search
+from worker import enqueue_capture
+from helper import decode_redis_data, redis_search, neo4j_search, context_search, redis_search_batch, context_search_batch, STAGES, get_stage_queue, stage_deferred
+from helper import create_capture, get_capture, is_terminal_event, TERMINAL_STATUSES, get_redis, get_driver, overloaded_stage, BACKPRESSURE_DELAY
+from helper import get_active_version, get_building_version
+from ingest_log import IngestLog
+from vector_store import get_vector_backend
+from endpoints import get_pool, SERVERS
 
 
 app = Flask(__name__)
 data_folder = './data'
 
-redis_conn = Redis(host='localhost', port=6379, decode_responses=False)
-queue = Queue('snippet_queue', connection=redis_conn)  # Create Redis-backed queue
+MAX_BATCH_QUERIES = int(os.getenv("MAX_BATCH_QUERIES", "500"))
+MAX_SEARCH_K = int(os.getenv("MAX_SEARCH_K", "100"))
 
 if not os.path.exists(data_folder):
     os.makedirs(data_folder)
 
+# Raw captures are made durable in the group-commit ingest log before they are queued,
+# so they can be replayed with `python ingest_log.py replay` if Redis loses them.
+ingest_log = IngestLog()
+
+# Connections and index checks happen once, in the background, after startup;
+# /ready reports when they are done so the server can take traffic immediately.
+readiness = {"ready": False, "checks": {}}
+
+def warm_up(retry_interval=5):
+    checks = {
+        "redis": lambda: get_redis().ping(),
+        "vector_index": lambda: get_vector_backend().ensure_index(),
+        "neo4j": lambda: get_driver().verify_connectivity(),
+    }
+    while True:
+        for name, check in checks.items():
+            if readiness["checks"].get(name) == "ok":
+                continue
+            try:
+                readiness["checks"][name] = "ok" if check() is not False else "error: check failed"
+            except Exception as e:
+                readiness["checks"][name] = f"error: {e}"
+        readiness["ready"] = all(status == "ok" for status in readiness["checks"].values())
+        print(f"Warm-up checks: {readiness['checks']}")
+        if readiness["ready"] or not retry_interval:
+            return
+        time.sleep(retry_interval)
+
 @app.route('/snippet', methods=['POST'])
 def snippet():
     data = request.json
     timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    
-    # Save the raw data for logging/debugging
-    filename = os.path.join(data_folder, f'snippet_{timestamp}.json')
-    with open(filename, 'w') as f:
-        json.dump(data, f)
-
-    # Enqueue the task for processing
-    job = queue.enqueue(embed_snippet, data, timestamp)
+    backfill = request.args.get('backfill', 'false').lower() == 'true'
+
+    # Shed load at the door once any stage is too far behind
+    stage = overloaded_stage()
+    if stage:
+        print(f"Stage '{stage}' is over its admission limit, rejecting capture.")
+        return jsonify({"error": f"Ingest is overloaded at stage '{stage}'", "retry_after": BACKPRESSURE_DELAY}), 429, \
+            {"Retry-After": str(BACKPRESSURE_DELAY)}
+
+    # The capture ID is the log record ID, the first job's ID and the tracking key
+    capture_id = str(uuid.uuid4())
+    ingest_log.append(capture_id, "snippet", data)
+    create_capture(capture_id)
+
+    job = enqueue_capture(data, timestamp, capture_id, backfill=backfill)
     print(f"Queued job {job.id} for processing.")
 
-    return jsonify({"message": "Snippet data received", "job_id": job.id}), 202
+    return jsonify({"message": "Snippet data received", "job_id": job.id, "capture_id": capture_id}), 202
 
 @app.route('/page', methods=['POST'])
 def page():
     data = request.json
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    filename = os.path.join(data_folder, f'page_{timestamp}.json')
-    with open(filename, 'w') as f:
-        json.dump(data, f)
+    ingest_log.append(str(uuid.uuid4()), "page", data)
     print("Received page data:", data)
     return jsonify({"message": "Page data received"}), 200
 
@@ -52,18 +90,22 @@ def page():
 def health():
     try:
         # Check Redis connection
-        redis_status = redis_conn.ping()
-
-        # Get queue stats
-        job_count = len(queue.jobs)  # Jobs in queue
-        started_registry = StartedJobRegistry(queue.name, connection=redis_conn)
-        active_jobs = len(started_registry.get_job_ids())
-
-        failed_registry = FailedJobRegistry(queue.name, connection=redis_conn)
-        failed_jobs = len(failed_registry.get_job_ids())
-
-        finished_registry = FinishedJobRegistry(queue.name, connection=redis_conn)
-        completed_jobs = len(finished_registry.get_job_ids())
+        redis_status = get_redis().ping()
+
+        # Get per-stage queue stats (fresh and backfill queues combined)
+        stages = {}
+        for stage, config in STAGES.items():
+            stats = {"pending_jobs": 0, "scheduled_jobs": 0, "deferred_jobs": stage_deferred(stage), "active_jobs": 0,
+                     "failed_jobs": 0, "completed_jobs": 0,
+                     "max_pending": config["max_pending"], "admit_limit": config["admit_limit"]}
+            for backfill in (False, True):
+                queue = get_stage_queue(stage, backfill)
+                stats["pending_jobs"] += len(queue)
+                stats["scheduled_jobs"] += queue.scheduled_job_registry.count
+                stats["active_jobs"] += len(StartedJobRegistry(queue.name, connection=get_redis()).get_job_ids())
+                stats["failed_jobs"] += len(FailedJobRegistry(queue.name, connection=get_redis()).get_job_ids())
+                stats["completed_jobs"] += len(FinishedJobRegistry(queue.name, connection=get_redis()).get_job_ids())
+            stages[stage] = stats
 
         # Get system resource usage
         memory_usage = psutil.virtual_memory().percent
@@ -71,12 +113,10 @@ def health():
 
         return jsonify({
             "status": "ok" if redis_status else "unhealthy",
-            "queue": {
-                "pending_jobs": job_count,
-                "active_jobs": active_jobs,
-                "failed_jobs": failed_jobs,
-                "completed_jobs": completed_jobs
-            },
+            "queues": stages,
+            # Replica health and latency as seen by this server's own (search) traffic
+            "model_servers": {role: get_pool(role).stats() for role in SERVERS},
+            "embeddings": {"active": get_active_version(), "building": get_building_version()},
             "system": {
                 "cpu_usage": f"{cpu_usage}%",
                 "memory_usage": f"{memory_usage}%"
@@ -86,10 +126,15 @@ def health():
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe: 200 once warm-up succeeded, 503 before that or if a check failed."""
+    return jsonify(readiness), 200 if readiness["ready"] else 503
+
 @app.route('/job_status/<job_id>', methods=['GET'])
 def job_status(job_id):
     try:
-        raw_job = redis_conn.hgetall(f"rq:job:{job_id}")
+        raw_job = get_redis().hgetall(f"rq:job:{job_id}")
         job = decode_redis_data(raw_job)
 
         desc = job["description"]
@@ -97,16 +142,80 @@ def job_status(job_id):
         return jsonify({
             "job_id": job_id,
             "started_at": job["started_at"],
-            "ended_at": job["ended_at"]
+            "ended_at": job["ended_at"],
+            "pipeline": get_capture(job_id)  # Every stage of the capture, not just this job
         }), 200
     except Exception as e:
         print(f"Error fetching job status: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@app.route('/capture/<capture_id>', methods=['GET'])
+def capture_status(capture_id):
+    capture = get_capture(capture_id)
+    if not capture:
+        return jsonify({"status": "error", "message": "Unknown capture"}), 404
+    return jsonify(capture), 200
+
+@app.route('/capture/<capture_id>/wait', methods=['GET'])
+def capture_wait(capture_id):
+    """Long-poll: return once the capture is indexed or failed, or after `timeout` seconds."""
+    timeout = min(float(request.args.get('timeout', 30)), 300)
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(f"capture:{capture_id}")
+    try:
+        # Subscribe before reading the status so a completion in between is not missed
+        capture = get_capture(capture_id)
+        if not capture:
+            return jsonify({"status": "error", "message": "Unknown capture"}), 404
+
+        deadline = datetime.now().timestamp() + timeout
+        while capture["status"] not in TERMINAL_STATUSES:
+            remaining = deadline - datetime.now().timestamp()
+            if remaining <= 0:
+                break
+            message = pubsub.get_message(timeout=remaining)
+            if message and is_terminal_event(json.loads(message["data"])):
+                capture = get_capture(capture_id)
+        return jsonify(capture), 200
+    finally:
+        pubsub.close()
+
+@app.route('/capture/<capture_id>/events', methods=['GET'])
+def capture_events(capture_id):
+    """Server-sent events for every stage transition, ending when the capture is indexed or failed."""
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(f"capture:{capture_id}")
+    capture = get_capture(capture_id)
+    if not capture:
+        pubsub.close()
+        return jsonify({"status": "error", "message": "Unknown capture"}), 404
+
+    def generate():
+        try:
+            yield f"data: {json.dumps(capture)}\n\n"
+            if capture["status"] in TERMINAL_STATUSES:
+                return
+            while True:
+                message = pubsub.get_message(timeout=15)
+                if not message:
+                    yield ": keepalive\n\n"  # Lets the server notice clients that went away
+                    continue
+                event = message["data"].decode("utf-8")
+                yield f"data: {event}\n\n"
+                if is_terminal_event(json.loads(event)):
+                    return
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
 @app.route('/failed_jobs', methods=['GET'])
 def failed_jobs():
-    failed_registry = FailedJobRegistry(queue.name, connection=redis_conn)
-    failed_job_ids = failed_registry.get_job_ids()
+    failed_job_ids = []
+    for stage in STAGES:
+        for backfill in (False, True):
+            queue = get_stage_queue(stage, backfill)
+            failed_job_ids += FailedJobRegistry(queue.name, connection=get_redis()).get_job_ids()
 
     return jsonify({
         "failed_jobs": failed_job_ids,
@@ -169,10 +278,59 @@ def search():
         print(f"Error during search: {e}")
         return jsonify({"error": "Search failed"}), 500
 
+def get_batch_queries(data):
+    """Validate a batch request body of the form {"queries": [...], "k": 5}; returns (queries, k, error)."""
+    queries = (data or {}).get("queries")
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q for q in queries):
+        return None, None, (jsonify({"error": "A non-empty list of query texts is required"}), 400)
+    if len(queries) > MAX_BATCH_QUERIES:
+        return None, None, (jsonify({"error": f"At most {MAX_BATCH_QUERIES} queries per batch"}), 400)
+    k = data.get("k", 5)
+    if isinstance(k, bool) or not isinstance(k, int) or not 1 <= k <= MAX_SEARCH_K:
+        return None, None, (jsonify({"error": f"k must be an integer between 1 and {MAX_SEARCH_K}"}), 400)
+    return queries, k, None
+
+# Batch endpoints share embedding, KNN, rerank and Neo4j work across queries and
+# stream one JSON object per query as newline-delimited JSON.
+@app.route('/rsearch/batch', methods=['POST'])
+def rsearch_batch():
+    data = request.json
+    queries, k, error = get_batch_queries(data)
+    if error:
+        return error
+
+    def generate():
+        try:
+            for query_text, documents in zip(queries, redis_search_batch(queries, k)):
+                yield json.dumps({"query": query_text, "documents": documents}) + "\n"
+        except Exception as e:
+            print(f"Error during batch search: {e}")
+            yield json.dumps({"error": "Search failed"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    data = request.json
+    queries, k, error = get_batch_queries(data)
+    if error:
+        return error
+
+    def generate():
+        try:
+            for query_text, result in context_search_batch(queries, k):
+                yield json.dumps({"query": query_text, "result": result}) + "\n"
+        except Exception as e:
+            print(f"Error during batch search: {e}")
+            yield json.dumps({"error": "Search failed"}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.before_request
 def log_request():
     with open("api_requests.log", "a") as log_file:
         log_file.write(f"{datetime.now()} - {request.method} {request.path}\n")
         
 if __name__ == '__main__':
+    threading.Thread(target=warm_up, daemon=True).start()
     app.run(host='0.0.0.0', port=5000)
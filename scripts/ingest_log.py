@@ -0,0 +1,219 @@
+import argparse
+import fcntl
+import glob
+import json
+import os
+import queue
+import threading
+import time
+import zlib
+
+# Configuration
+INGEST_LOG_DIR = os.getenv("INGEST_LOG_DIR", "./data/ingest")
+SEGMENT_MAX_BYTES = int(os.getenv("INGEST_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))  # Roll to a new segment past this size
+SEGMENT_MAX_AGE = float(os.getenv("INGEST_SEGMENT_MAX_HOURS", "24")) * 3600  # ...or once its first record is this old
+RETENTION_HOURS = float(os.getenv("INGEST_RETENTION_HOURS", str(24 * 7)))  # The replay window; older indexed segments are deleted
+GROUP_COMMIT_MS = float(os.getenv("INGEST_GROUP_COMMIT_MS", "5"))  # How long a commit waits for more records to share its fsync
+GROUP_COMMIT_MAX_RECORDS = 256
+
+class IngestLog:
+    """
+    Durable, segmented append-only log of raw ingest payloads.
+
+    Records are written as "<crc32> <json>" lines to segment-<n>.log files. append()
+    returns only once its record is on disk; a single writer thread batches whatever
+    records arrive within GROUP_COMMIT_MS into one write and one fsync, so concurrent
+    captures share the cost of durability. Segments are rolled at SEGMENT_MAX_BYTES or
+    SEGMENT_MAX_AGE and an fcntl lock keeps several processes appending to the same
+    directory safe. prune() deletes rolled segments past the retention window once
+    every capture in them has been indexed.
+    """
+
+    def __init__(self, directory=INGEST_LOG_DIR):
+        self.directory = directory
+        self.lock_file = os.path.join(directory, ".lock")
+        self._pending = queue.Queue()
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, "segment-*.log")))
+
+    def _segment_path(self, number):
+        return os.path.join(self.directory, f"segment-{number:08d}.log")
+
+    def _current_segment(self):
+        """Latest segment, or a new one if it is full or old. Caller holds the file lock."""
+        segments = self.segments()
+        if not segments:
+            return self._segment_path(1)
+        latest = segments[-1]
+        if os.path.getsize(latest) < SEGMENT_MAX_BYTES and self._first_timestamp(latest) > time.time() - SEGMENT_MAX_AGE:
+            return latest
+        number = int(os.path.basename(latest)[len("segment-"):-len(".log")])
+        return self._segment_path(number + 1)
+
+    def _first_timestamp(self, segment):
+        """Timestamp of a segment's first intact record (now if it has none yet)."""
+        for record in self._read_segment(segment):
+            return record["ts"]
+        return time.time()
+
+    def append(self, record_id, kind, payload):
+        """Durably append a record and return its location as (segment file, record id)."""
+        line = json.dumps({"id": record_id, "kind": kind, "ts": time.time(), "payload": payload})
+        entry = {"line": f"{zlib.crc32(line.encode('utf-8')):08x} {line}\n", "done": threading.Event()}
+
+        self._ensure_writer()
+        self._pending.put(entry)
+        entry["done"].wait()
+        if "error" in entry:
+            raise entry["error"]
+        return entry["segment"], record_id
+
+    def _ensure_writer(self):
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            deadline = time.monotonic() + GROUP_COMMIT_MS / 1000
+            while len(batch) < GROUP_COMMIT_MAX_RECORDS:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        """Write a batch with one write and one fsync, then release its waiters."""
+        try:
+            with open(self.lock_file, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    segment = self._current_segment()
+                    with open(segment, "a") as f:
+                        f.write("".join(entry["line"] for entry in batch))
+                        f.flush()
+                        os.fsync(f.fileno())
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+            for entry in batch:
+                entry["segment"] = os.path.basename(segment)
+        except Exception as e:
+            for entry in batch:
+                entry["error"] = e
+        finally:
+            for entry in batch:
+                entry["done"].set()
+
+    def read(self, since=0):
+        """Yield every intact record with a timestamp >= `since`, oldest first. Torn or corrupt lines are skipped."""
+        for segment in self.segments():
+            for record in self._read_segment(segment):
+                if record["ts"] >= since:
+                    yield record
+
+    def _read_segment(self, segment):
+        with open(segment) as f:
+            for line in f:
+                crc, _, body = line.rstrip("\n").partition(" ")
+                try:
+                    if int(crc, 16) != zlib.crc32(body.encode("utf-8")):
+                        raise ValueError("checksum mismatch")
+                    record = json.loads(body)
+                except ValueError:
+                    print(f"Skipping corrupt record in {os.path.basename(segment)}")
+                    continue
+                yield record
+
+    def prune(self, is_indexed, retention_hours=RETENTION_HOURS):
+        """
+        Delete rolled segments whose last record is older than `retention_hours` and whose
+        snippet captures were all indexed; returns the deleted segment names.
+
+        `is_indexed(capture_id)` is asked while the captures are still tracked (rolled
+        segments are checked on every run, long before CAPTURE_TTL), and the answer is kept
+        in a segment-<n>.indexed marker. A segment with a failed or lost capture is kept
+        until a replay indexes it.
+        """
+        cutoff = time.time() - retention_hours * 3600
+        deleted = []
+        with open(self.lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                for segment in self.segments()[:-1]:  # Never the segment being appended to
+                    marker = segment[:-len(".log")] + ".indexed"
+                    if not os.path.exists(marker):
+                        captures = [r["id"] for r in self._read_segment(segment) if r["kind"] == "snippet"]
+                        if not all(is_indexed(capture_id) for capture_id in captures):
+                            continue
+                        open(marker, "w").close()
+                    if os.path.getmtime(segment) < cutoff:
+                        os.remove(segment)
+                        os.remove(marker)
+                        deleted.append(os.path.basename(segment))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return deleted
+
+def replay(since=0, replay_all=False):
+    """
+    Re-enqueue logged snippet captures that were lost (e.g. Redis lost their queues and
+    tracking) or failed. Captures that are indexed or still queued or running are
+    skipped unless `replay_all` is set. Document IDs derive from the capture ID, so a
+    replay overwrites a capture's documents rather than duplicating them.
+    """
+    from helper import create_capture, get_capture
+    from worker import enqueue_capture
+
+    replayed = 0
+    for record in IngestLog().read(since):
+        if record["kind"] != "snippet":
+            continue
+        capture = get_capture(record["id"])
+        if capture and capture["status"] != "failed" and not replay_all:
+            continue
+        create_capture(record["id"])
+        timestamp = time.strftime('%Y%m%d%H%M%S', time.localtime(record["ts"]))
+        enqueue_capture(record["payload"], timestamp, record["id"], backfill=True)
+        replayed += 1
+    print(f"Replayed {replayed} captures from the ingest log.")
+    return replayed
+
+def prune(retention_hours=RETENTION_HOURS):
+    """Delete ingest log segments older than the replay window whose captures are all indexed."""
+    from helper import get_capture
+
+    def is_indexed(capture_id):
+        capture = get_capture(capture_id)
+        return bool(capture) and capture["status"] == "indexed"
+
+    deleted = IngestLog().prune(is_indexed, retention_hours)
+    print(f"Pruned {len(deleted)} ingest log segments.")
+    return deleted
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captures from, or prune, the durable ingest log.")
+    parser.add_argument("command", choices=["replay", "prune"])
+    parser.add_argument("--since-hours", type=float, default=RETENTION_HOURS,
+                        help="replay: only replay records this recent; prune: keep segments this recent (default: one week)")
+    parser.add_argument("--all", action="store_true", help="Also replay captures that are indexed, queued or running")
+    parser.add_argument("--interval", type=int, default=0, help="prune: repeat every N seconds (0 runs once)")
+    args = parser.parse_args()
+
+    if args.command == "replay":
+        replay(since=time.time() - args.since_hours * 3600, replay_all=args.all)
+    else:
+        while True:
+            prune(args.since_hours)
+            if not args.interval:
+                break
+            time.sleep(args.interval)
@@ -0,0 +1,291 @@
+"""
+Online migration to a new embedding model version.
+
+    python reembed.py start nomic-embed-v2 --dim 384 --servers http://localhost:8050/embedding
+    python reembed.py status
+
+(setup.sh gives replica i of each model server port base + 100*i, e.g. 8000, 8100, ...
+for the embed-server, so run the new model on a port outside those ranges.)
+
+`start` registers the version and marks it as building: from then on new documents are
+embedded with both the active and the new model. The job then re-embeds every existing
+hot and archived document in rate-limited batches into the new version's own index,
+while searches keep reading the active one. Once nothing is missing and the index has
+caught up, the active version is switched in one Redis transaction. Documents without
+a snippet, or that the new model keeps rejecting, are recorded as skipped so they do not
+hold up the switch; `status` lists them. Interrupted runs resume where they left off;
+`drop` removes a retired version's vectors.
+"""
+
+import gc  # Import garbage collection module
+
+import argparse
+import json
+import re
+import time
+
+import requests
+
+from helper import get_redis, decode_redis_data, embed_texts, register_embedding_version
+from helper import get_active_version, get_building_version, ACTIVE_VERSION_KEY, BUILDING_VERSION_KEY
+from helper import EMBEDDING_VERSIONS_KEY, VERSION_CACHE_SECONDS, TOUCH_IF_EXISTS
+from vector_store import get_vector_backend, version_field
+from tiering import get_cold_store, _read_docs
+
+# Configuration
+REEMBED_BATCH_SIZE = 32  # Snippets per embedding request
+REEMBED_RATE = 20.0  # Documents per second, leaving the embedding servers room for live traffic
+PROGRESS_KEY = "embedding:progress:{version}"
+SKIPPED_KEY = "embedding:skipped:{version}"  # Doc key -> why it is not re-embedded
+FAILURES_KEY = "embedding:failures:{version}"  # Doc key -> failed attempts so far
+REEMBED_MAX_ATTEMPTS = 3  # A document failing this many times on its own is skipped
+RETRY_DELAY = 30  # Seconds to wait before another pass when a pass made no progress
+SCAN_CHUNK = 1000
+
+def get_skipped(version):
+    """Doc keys `version` will not re-embed, with the reason for each."""
+    return {
+        key.decode("utf-8"): reason.decode("utf-8")
+        for key, reason in get_redis().hgetall(SKIPPED_KEY.format(version=version)).items()
+    }
+
+def skip(version, keys, reason):
+    if keys:
+        get_redis().hset(SKIPPED_KEY.format(version=version), mapping={key: reason for key in keys})
+        print(f"Skipping {len(keys)} documents for version '{version}': {reason}")
+
+def find_missing(version):
+    """
+    Hot and cold document keys that have an active-version vector but none for `version`
+    yet, leaving out the ones recorded as skipped.
+    """
+    active = get_active_version()
+    skipped = set(get_skipped(version))
+    hot_missing = []
+    keys = [key.decode("utf-8") for key in get_redis().scan_iter(match="doc:*", count=SCAN_CHUNK)]
+    keys = [key for key in keys if key not in skipped]
+    for i in range(0, len(keys), SCAN_CHUNK):
+        chunk = keys[i:i + SCAN_CHUNK]
+        present = get_vector_backend(version).get(chunk)
+        hot_missing += [key for key in chunk if key not in present]
+
+    cold_missing = sorted(set(get_cold_store(active).keys()) - set(get_cold_store(version).keys()) - skipped)
+    return hot_missing, cold_missing
+
+def read_snippets(keys, cold=False):
+    """
+    Snippets of the documents that still exist in the given tier, by key. A document
+    that moved to the other tier meanwhile is left out; one without a snippet maps to "".
+    """
+    if cold:
+        docs = _read_docs()
+        return {key: docs[key].get("snippet", "") for key in keys if key in docs}
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        pipe.exists(key)
+        pipe.hget(key, "snippet")
+    replies = pipe.execute()
+    return {
+        key: (snippet or b"").decode("utf-8")
+        for key, exists, snippet in zip(keys, replies[::2], replies[1::2]) if exists
+    }
+
+def reembed_batch(keys, version, cold=False):
+    """
+    Embed a batch of documents with `version` and store the vectors in its hot or cold
+    store. Hot documents archived by tiering while the batch runs are left for the
+    cold pass instead of being skipped or leaving a stray vector behind.
+    """
+    texts = read_snippets(keys, cold)
+    skip(version, [key for key, text in texts.items() if not text.strip()], "no snippet")
+    keys = [key for key in keys if texts.get(key, "").strip()]
+    if not keys:
+        return 0
+    vectors = embed_texts([texts[key] for key in keys], version)
+    if cold:
+        get_cold_store(version).add(zip(keys, vectors))
+        return len(keys)
+
+    get_vector_backend(version).add(zip(keys, vectors))
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        pipe.hexists(key, "snippet")
+    archived = [key for key, exists in zip(keys, pipe.execute()) if not exists]
+    if archived:
+        get_vector_backend(version).delete(archived)
+    # Tag the rest, never recreating a hash that tiering has deleted since
+    touch = get_redis().register_script(TOUCH_IF_EXISTS)
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        if key not in archived:
+            touch(keys=[key], args=["embedding_version", version], client=pipe)
+    pipe.execute()
+    return len(keys) - len(archived)
+
+def is_transient(error):
+    """Whether a re-embedding error is the servers' fault (down, overloaded) rather than the document's."""
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+def reembed_each(keys, version, cold):
+    """
+    Re-embed a failed batch one document at a time, counting failures per document and
+    skipping those that reach REEMBED_MAX_ATTEMPTS. Stops at the first transient error.
+    """
+    done = 0
+    failures_key = FAILURES_KEY.format(version=version)
+    for key in keys:
+        try:
+            done += reembed_batch([key], version, cold)
+        except Exception as e:
+            if is_transient(e):
+                print(f"Embedding servers for version '{version}' are unavailable: {e}")
+                break
+            if get_redis().hincrby(failures_key, key, 1) >= REEMBED_MAX_ATTEMPTS:
+                skip(version, [key], f"failed {REEMBED_MAX_ATTEMPTS} times: {e}")
+    return done
+
+def catch_up(version, rate=REEMBED_RATE, batch_size=REEMBED_BATCH_SIZE):
+    """Re-embed everything `version` is missing; returns the number of documents embedded."""
+    hot_missing, cold_missing = find_missing(version)
+    total = len(hot_missing) + len(cold_missing)
+    progress_key = PROGRESS_KEY.format(version=version)
+    get_redis().hset(progress_key, mapping={"remaining": total, "updated_at": time.time()})
+
+    done = 0
+    batches = [(hot_missing[i:i + batch_size], False) for i in range(0, len(hot_missing), batch_size)]
+    batches += [(cold_missing[i:i + batch_size], True) for i in range(0, len(cold_missing), batch_size)]
+    for keys, cold in batches:
+        if get_building_version() != version:
+            print(f"Version '{version}' is no longer being built, stopping.")
+            break
+        started = time.time()
+        try:
+            done += reembed_batch(keys, version, cold)
+        except Exception as e:
+            print(f"Failed to re-embed {len(keys)} documents: {e}")
+            if not is_transient(e):
+                done += reembed_each(keys, version, cold)
+        finally:
+            gc.collect()
+        get_redis().hset(progress_key, mapping={"remaining": total - done, "updated_at": time.time()})
+        # Rate limit: never exceed `rate` documents per second on average
+        time.sleep(max(0.0, len(keys) / rate - (time.time() - started)))
+    return done
+
+def switch_version(version):
+    """Make `version` the one searches read from, atomically for every process."""
+    pipe = get_redis().pipeline(transaction=True)
+    pipe.set(ACTIVE_VERSION_KEY, version)
+    pipe.delete(BUILDING_VERSION_KEY)
+    pipe.execute()
+    print(f"Switched the active embedding version to '{version}'.")
+
+def build_version(version, rate=REEMBED_RATE, batch_size=REEMBED_BATCH_SIZE):
+    """Catch `version` up with the active index, switch to it, then sweep up stragglers."""
+    while get_building_version() == version:
+        embedded = catch_up(version, rate, batch_size)
+        hot_missing, cold_missing = find_missing(version)
+        if hot_missing or cold_missing:
+            if not embedded:
+                print(f"No progress on {len(hot_missing) + len(cold_missing)} documents, retrying in {RETRY_DELAY}s.")
+                time.sleep(RETRY_DELAY)
+            continue
+        if not get_vector_backend(version).indexing_done():
+            time.sleep(1)
+            continue
+        skipped = get_skipped(version)
+        if skipped:
+            print(f"{len(skipped)} skipped documents will not be found by '{version}' searches; see `status`.")
+        switch_version(version)
+
+        # Writers may keep using the old version for up to VERSION_CACHE_SECONDS; catch their documents
+        time.sleep(VERSION_CACHE_SECONDS)
+        hot_missing, cold_missing = find_missing(version)
+        for i in range(0, len(hot_missing), batch_size):
+            reembed_batch(hot_missing[i:i + batch_size], version)
+        for i in range(0, len(cold_missing), batch_size):
+            reembed_batch(cold_missing[i:i + batch_size], version, cold=True)
+        return True
+    return False
+
+def start(version, dim, servers, rate=REEMBED_RATE, batch_size=REEMBED_BATCH_SIZE):
+    if not re.fullmatch(r"[A-Za-z0-9_.-]+", version) or version.startswith("gen-"):
+        # Versions become subdirectories of the embedded stores, next to their gen-* directories
+        raise ValueError("Version names may only contain letters, digits, '.', '_' and '-', and not start with 'gen-'")
+    # ...and hash fields next to the embedding_version tag and the other versions' fields
+    taken = {"embedding_version"} | {
+        version_field(name.decode("utf-8")) for name in get_redis().hkeys(EMBEDDING_VERSIONS_KEY)
+        if name.decode("utf-8") != version
+    }
+    if version_field(version) in taken:
+        raise ValueError(f"Version '{version}' would share the field '{version_field(version)}' with another version")
+    if version == get_active_version():
+        print(f"'{version}' is already the active embedding version.")
+        return False
+    building = get_building_version()
+    if building and building != version:
+        raise RuntimeError(f"Version '{building}' is already being built; abort it first")
+
+    if dim and servers:
+        register_embedding_version(version, dim, servers)
+    if not get_redis().hexists(EMBEDDING_VERSIONS_KEY, version):
+        raise ValueError(f"Unknown version '{version}': pass --dim and --servers to register it")
+    get_vector_backend(version).ensure_index()
+    get_redis().set(BUILDING_VERSION_KEY, version)
+    # Wait for every process to pick up the building version before scanning for work
+    time.sleep(VERSION_CACHE_SECONDS)
+    return build_version(version, rate, batch_size)
+
+def status():
+    versions = {
+        name.decode("utf-8"): json.loads(spec) for name, spec in get_redis().hgetall(EMBEDDING_VERSIONS_KEY).items()
+    }
+    building = get_building_version()
+    report = {"active": get_active_version(), "building": building, "versions": versions}
+    if building:
+        report["progress"] = decode_redis_data(get_redis().hgetall(PROGRESS_KEY.format(version=building)))
+    # Documents the newest version could not embed, and so cannot find
+    report["skipped"] = get_skipped(building or report["active"])
+    print(json.dumps(report, indent=2))
+    return report
+
+def abort():
+    """Stop building the new version; its partial vectors stay until dropped."""
+    get_redis().delete(BUILDING_VERSION_KEY)
+    print("Stopped building the new embedding version.")
+
+def drop(version):
+    """Delete the hot and cold vectors of a version that is neither active nor being built."""
+    if version in (get_active_version(), get_building_version()):
+        raise RuntimeError(f"Version '{version}' is in use and cannot be dropped")
+    get_vector_backend(version).drop()
+    get_cold_store(version).drop()
+    get_redis().delete(*(key.format(version=version) for key in (PROGRESS_KEY, SKIPPED_KEY, FAILURES_KEY)))
+    print(f"Dropped the vectors of embedding version '{version}'.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-embed every document with a new embedding model and switch to it.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    start_parser = subparsers.add_parser("start", help="Build (or resume building) a version and switch to it")
+    start_parser.add_argument("version")
+    start_parser.add_argument("--dim", type=int, help="Embedding dimension of the new model")
+    start_parser.add_argument("--servers", help="Comma-separated embedding server URLs serving the new model")
+    start_parser.add_argument("--rate", type=float, default=REEMBED_RATE, help="Documents re-embedded per second")
+    start_parser.add_argument("--batch-size", type=int, default=REEMBED_BATCH_SIZE)
+    subparsers.add_parser("status", help="Show versions and re-embedding progress")
+    subparsers.add_parser("abort", help="Stop building the new version")
+    drop_parser = subparsers.add_parser("drop", help="Delete a retired version's vectors")
+    drop_parser.add_argument("version")
+    args = parser.parse_args()
+
+    if args.command == "start":
+        servers = args.servers.split(",") if args.servers else None
+        start(args.version, args.dim, servers, args.rate, args.batch_size)
+    elif args.command == "status":
+        status()
+    elif args.command == "abort":
+        abort()
+    else:
+        drop(args.version)
@@ -2,7 +2,13 @@ import unittest
 import json
 import time
 from redis import Redis
-from worker import embed_snippet, extract_snippet, load_snippet, decode_redis_data
+from worker import embed_snippet, extract_snippet, load_snippet, ingest_snippets, decode_redis_data
+
+BURST_KEY = "test:burst_jobs"
+
+def record_burst_job(index):
+    """Job for test_deferred_burst_drains: remember that it ran."""
+    Redis(host="localhost", port=6379).sadd(BURST_KEY, index)
 
 class TestWorkerFunctions(unittest.TestCase):
     
@@ -49,6 +55,18 @@ class TestWorkerFunctions(unittest.TestCase):
         # Check for any Neo4j-related exceptions during execution
         self.assertTrue(True, "Neo4j operation completed without errors")
         
+    def test_fused_ingest(self):
+        """Test the fused embed -> extract -> load path for a small capture."""
+        doc_ids = ingest_snippets(self.test_data["data"], self.test_data["timestamp"])
+        self.assertEqual(len(doc_ids), 1, "Fused ingest should produce one document")
+
+        doc_data = decode_redis_data(self.redis_conn.hgetall(f"doc:{doc_ids[0]}"))
+        self.assertIn("embedding", doc_data, "Embedding not stored in Redis")
+        self.assertIn("relations", doc_data, "Relations not stored in Redis")
+        self.assertIn("named_entities", doc_data, "Named entities not stored in Redis")
+
+        self.redis_conn.delete(f"doc:{doc_ids[0]}")
+
     def test_stress_test(self):
         """Stress test extraction by running extract_snippet 10 times for 10 docs in Redis."""
         # Create 10 test documents in Redis
@@ -95,6 +113,99 @@ class TestWorkerFunctions(unittest.TestCase):
         for doc_id in test_doc_ids:
             self.redis_conn.delete(f"doc:{doc_id}")
             
+    def test_capture_partial_failure(self):
+        """One document failing a stage must not complete a capture whose other documents are still running."""
+        from helper import create_capture, set_capture_documents, track_stage, finish_capture_document, get_capture, CAPTURE_CHANNEL
+
+        capture_id = "test-capture-partial-failure"
+        pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(CAPTURE_CHANNEL, f"capture:{capture_id}")
+        try:
+            create_capture(capture_id)
+            set_capture_documents(capture_id, 3)
+            track_stage(capture_id, "extract", "failed")
+            finish_capture_document(capture_id, failed=True)
+            self.assertEqual(get_capture(capture_id)["status"], "queued", "Capture ended after one document failed")
+
+            for _ in range(2):
+                track_stage(capture_id, "load", "finished")
+                finish_capture_document(capture_id)
+            self.assertEqual(get_capture(capture_id)["status"], "failed")
+
+            events = []
+            while (message := pubsub.get_message(timeout=1)):
+                events.append((message["channel"].decode("utf-8"), json.loads(message["data"])))
+            completions = [event for channel, event in events if channel == CAPTURE_CHANNEL]
+            self.assertEqual(completions, [{"capture_id": capture_id, "status": "failed"}])
+            stage_events = [event for channel, event in events if channel != CAPTURE_CHANNEL and "stage" in event]
+            self.assertEqual([event["stage_status"] for event in stage_events], ["failed", "finished", "finished"])
+        finally:
+            pubsub.close()
+            self.redis_conn.delete(f"capture:{capture_id}")
+
+    def test_snippet_backpressure(self):
+        """Jobs waiting in a stage's scheduled registry count towards its admission limit."""
+        import importlib.util
+        from datetime import timedelta
+        from helper import STAGES, get_stage_queue, stage_pending
+
+        spec = importlib.util.spec_from_file_location("http_server", "http-server.py")
+        http_server = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(http_server)
+
+        original_limit = STAGES["embed"]["admit_limit"]
+        queue = get_stage_queue("embed", backfill=True)
+        jobs = []
+        try:
+            STAGES["embed"]["admit_limit"] = stage_pending("embed") + 3
+            jobs = [queue.enqueue_in(timedelta(hours=1), embed_snippet, args=([], "20250323231428")) for _ in range(3)]
+            self.assertGreaterEqual(stage_pending("embed"), STAGES["embed"]["admit_limit"])
+
+            response = http_server.app.test_client().post("/snippet", json=self.test_data["data"])
+            self.assertEqual(response.status_code, 429)
+            self.assertIn("Retry-After", response.headers)
+            self.assertIn("embed", response.get_json()["error"])
+        finally:
+            STAGES["embed"]["admit_limit"] = original_limit
+            for job in jobs:
+                job.delete()
+
+    def test_deferred_burst_drains(self):
+        """A burst of more than max_pending jobs is deferred and then fully released, not re-deferred forever."""
+        import helper
+        from rq import SimpleWorker
+        from rq.scheduler import RQScheduler
+        from helper import STAGES, enqueue_stage, get_stage_queue, get_deferred_queue, stage_pending, stage_deferred
+
+        STAGES["burst"] = {"queue": "test_burst_queue", "max_pending": 5, "admit_limit": 10}
+        original_delay = helper.BACKPRESSURE_DELAY
+        helper.BACKPRESSURE_DELAY = 0
+        queues = [get_stage_queue("burst"), get_deferred_queue("burst"), get_stage_queue("burst", backfill=True)]
+        try:
+            for i in range(12):
+                enqueue_stage("burst", record_burst_job, args=(i,))
+            self.assertEqual(stage_pending("burst"), 5)
+            self.assertEqual(stage_deferred("burst"), 7)
+
+            scheduler = RQScheduler(queues, connection=self.redis_conn)
+            scheduler.prepare_registries([queue.name for queue in queues])
+            worker = SimpleWorker(queues, connection=self.redis_conn)
+            for _ in range(10):
+                scheduler.enqueue_scheduled_jobs()
+                worker.work(burst=True)
+                if stage_pending("burst") == 0 and stage_deferred("burst") == 0:
+                    break
+            ran = {int(index) for index in self.redis_conn.smembers(BURST_KEY)}
+            self.assertEqual(ran, set(range(12)))
+        finally:
+            helper.BACKPRESSURE_DELAY = original_delay
+            for queue in queues:
+                queue.empty()
+                for job_id in queue.scheduled_job_registry.get_job_ids():
+                    queue.scheduled_job_registry.remove(job_id, delete_job=True)
+            del STAGES["burst"]
+            self.redis_conn.delete(BURST_KEY)
+
     @classmethod
     def tearDownClass(cls):
         """Cleanup: Remove test data from Redis."""
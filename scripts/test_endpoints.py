@@ -0,0 +1,87 @@
+import unittest
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import endpoints
+from endpoints import EndpointPool
+
+class StubHandler(BaseHTTPRequestHandler):
+    """llama-server stand-in: answers /health and POSTs, or fails with 503 while `down` is set."""
+
+    def respond(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.respond(503 if self.server.down else 200, {"status": "ok"})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.delay)
+        self.server.hits += 1
+        if self.server.down:
+            self.respond(503, {"error": "unavailable"})
+        else:
+            self.respond(200, {"port": self.server.server_address[1]})
+
+    def log_message(self, format, *args):
+        pass
+
+class TestEndpointPool(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = []
+        for _ in range(2):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+            server.down, server.delay, server.hits = False, 0.0, 0
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        self.pool = EndpointPool("embedding", [f"http://127.0.0.1:{s.server_address[1]}/embedding" for s in self.servers])
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def test_least_outstanding_routing(self):
+        """Concurrent requests spread over both replicas instead of piling onto one."""
+        for server in self.servers:
+            server.delay = 0.2
+        threads = [threading.Thread(target=self.pool.post, kwargs={"json": {}}) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([server.hits for server in self.servers], [2, 2])
+        self.assertTrue(all(stats["requests"] == 2 for stats in self.pool.stats()))
+
+    def test_ejection_and_readmission(self):
+        """A failing replica is skipped, ejected, and re-admitted once /health recovers."""
+        self.servers[0].down = True
+        for _ in range(endpoints.EJECT_AFTER_FAILURES + 2):
+            response = self.pool.post(json={})
+            self.assertEqual(response.json()["port"], self.servers[1].server_address[1])
+        self.assertFalse(self.pool.stats()[0]["healthy"])
+
+        self.servers[0].down = False
+        self.pool.replicas[0].ejected_until = time.time()  # Let the ejection expire
+        self.pool.post(json={})
+        self.assertTrue(self.pool.stats()[0]["healthy"])
+
+    def test_hanging_replica_times_out(self):
+        """A replica that accepts the request but does not answer in time fails over and counts as an error."""
+        self.servers[0].delay = 1.0
+        pool = EndpointPool("embedding", [replica.url for replica in self.pool.replicas], timeout=0.2)
+        response = pool.post(json={})
+        self.assertEqual(response.json()["port"], self.servers[1].server_address[1])
+        self.assertEqual(pool.stats()[0]["errors"], 1)
+        self.assertEqual(pool.stats()[0]["outstanding"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
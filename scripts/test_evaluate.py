@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+
+from evaluate import exact_knn, knn_gains, ndcg, pick_fastest
+
+class TestEvaluate(unittest.TestCase):
+
+    def test_exact_knn_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        matrix = rng.standard_normal((50, 8)).astype(np.float32)
+        queries = rng.standard_normal((5, 8)).astype(np.float32)
+        expected = [np.argsort(((matrix - query) ** 2).sum(axis=1))[:4] for query in queries]
+        np.testing.assert_array_equal(exact_knn(queries, matrix, 4), expected)
+
+    def test_exact_knn_excludes_the_query_document(self):
+        matrix = np.array([[0.0], [1.0], [3.0]], dtype=np.float32)
+        # Each query is a stored document; k is capped at the other documents
+        self.assertEqual(exact_knn(matrix, matrix, 5, exclude=np.arange(3)).tolist(), [[1, 2], [0, 2], [1, 0]])
+
+    def test_knn_gains(self):
+        self.assertEqual(knn_gains(["doc:a", "doc:b", "doc:c"]), {"doc:a": 3, "doc:b": 2, "doc:c": 1})
+
+    def test_ndcg(self):
+        gains = knn_gains(["doc:a", "doc:b", "doc:c"])
+        self.assertAlmostEqual(ndcg(["doc:a", "doc:b", "doc:c"], gains, 3), 1.0)
+        reversed_dcg = 1 + 2 / np.log2(3) + 3 / np.log2(4)
+        ideal_dcg = 3 + 2 / np.log2(3) + 1 / np.log2(4)
+        self.assertAlmostEqual(ndcg(["doc:c", "doc:b", "doc:a"], gains, 3), reversed_dcg / ideal_dcg)
+        # Only the top k count, against the best possible top k
+        self.assertAlmostEqual(ndcg(["doc:a", "doc:x"], gains, 1), 1.0)
+        self.assertEqual(ndcg(["doc:x"], gains, 3), 0.0)
+        self.assertEqual(ndcg(["doc:a"], {}, 3), 0.0)
+
+    def test_pick_fastest(self):
+        report = [
+            {"recall_at_k": 0.95, "knn_ndcg_at_k": 0.9, "total_p95_ms": 20},
+            {"recall_at_k": 0.85, "knn_ndcg_at_k": 0.9, "total_p95_ms": 5},
+            {"recall_at_k": 0.99, "knn_ndcg_at_k": 0.9, "total_p95_ms": 10},
+        ]
+        self.assertEqual(pick_fastest(report, 0.9, 0.5)["total_p95_ms"], 10)
+        self.assertIsNone(pick_fastest(report, 0.9, 0.95))
+
+if __name__ == "__main__":
+    unittest.main()
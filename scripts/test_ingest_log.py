@@ -0,0 +1,102 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from unittest import mock
+
+import ingest_log
+from ingest_log import IngestLog
+
+class TestIngestLog(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.log = IngestLog(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_append_and_read(self):
+        segment, record_id = self.log.append("capture-1", "snippet", [{"text": "hello"}])
+        self.assertEqual(record_id, "capture-1")
+        self.assertEqual(segment, "segment-00000001.log")
+        records = list(IngestLog(self.path).read())
+        self.assertEqual([(r["id"], r["kind"], r["payload"]) for r in records],
+                         [("capture-1", "snippet", [{"text": "hello"}])])
+        self.assertEqual(list(self.log.read(since=records[0]["ts"] + 1)), [])
+
+    def test_torn_and_corrupt_lines_are_skipped(self):
+        for i in range(3):
+            self.log.append(f"capture-{i}", "snippet", {"n": i})
+        segment = self.log.segments()[0]
+        with open(segment) as f:
+            lines = f.readlines()
+        # Flip a payload byte without fixing the checksum, and leave a torn line at the end
+        lines[1] = lines[1].replace('"n": 1', '"n": 7')
+        lines.append(lines[2][:len(lines[2]) // 2])
+        with open(segment, "w") as f:
+            f.writelines(lines)
+
+        self.assertEqual([r["id"] for r in self.log.read()], ["capture-0", "capture-2"])
+
+    def test_segment_roll_over(self):
+        with mock.patch("ingest_log.SEGMENT_MAX_BYTES", 200):
+            for i in range(10):
+                self.log.append(f"capture-{i}", "snippet", {"text": "x" * 50})
+        segments = self.log.segments()
+        self.assertGreater(len(segments), 1)
+        # Every segment but the last was rolled once it passed the limit
+        for segment in segments[:-1]:
+            self.assertGreaterEqual(os.path.getsize(segment), 200)
+        self.assertEqual([r["id"] for r in self.log.read()], [f"capture-{i}" for i in range(10)])
+
+    def test_segment_rolls_by_age(self):
+        self.log.append("capture-0", "snippet", {})
+        with mock.patch("ingest_log.SEGMENT_MAX_AGE", 0):
+            self.log.append("capture-1", "snippet", {})
+        self.log.append("capture-2", "snippet", {})
+        self.assertEqual([os.path.basename(segment) for segment in self.log.segments()],
+                         ["segment-00000001.log", "segment-00000002.log"])
+
+    def test_prune_keeps_unindexed_and_recent_segments(self):
+        with mock.patch("ingest_log.SEGMENT_MAX_BYTES", 1):
+            for i in range(4):
+                self.log.append(f"capture-{i}", "snippet", {})
+        segments = self.log.segments()
+        self.assertEqual(len(segments), 4)
+
+        # Within the retention window nothing is deleted, but indexed segments are marked
+        indexed = {"capture-0", "capture-2", "capture-3"}
+        self.assertEqual(self.log.prune(lambda capture_id: capture_id in indexed, retention_hours=1), [])
+
+        # Past it, marked segments go even though their captures are no longer tracked;
+        # capture-1 was never indexed and the latest segment is still being appended to
+        for segment in segments:
+            os.utime(segment, (0, 0))
+        self.assertEqual(self.log.prune(lambda capture_id: False, retention_hours=1),
+                         ["segment-00000001.log", "segment-00000003.log"])
+        self.assertEqual([r["id"] for r in self.log.read()], ["capture-1", "capture-3"])
+        self.assertEqual(sorted(os.listdir(self.path)), [".lock", "segment-00000002.log", "segment-00000004.log"])
+
+    def test_group_commit_shares_fsyncs(self):
+        appends = 50
+        start = threading.Barrier(appends)
+
+        def append(i):
+            start.wait()
+            self.log.append(f"capture-{i}", "snippet", {"n": i})
+
+        with mock.patch("ingest_log.GROUP_COMMIT_MS", 50), \
+                mock.patch("ingest_log.os.fsync", wraps=os.fsync) as fsync:
+            threads = [threading.Thread(target=append, args=(i,)) for i in range(appends)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertLess(fsync.call_count, appends)
+        self.assertEqual(sorted(r["payload"]["n"] for r in self.log.read()), list(range(appends)))
+
+if __name__ == "__main__":
+    unittest.main()
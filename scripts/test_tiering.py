@@ -0,0 +1,268 @@
+import unittest
+import fnmatch
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import helper
+import reembed
+import tiering
+import vector_store
+from helper import store_document_in_redis, register_embedding_version, TOUCH_IF_EXISTS, BUILDING_VERSION_KEY
+
+class FakeRedis:
+    """The subset of redis-py used by tiering and reembed, over in-memory dicts and hashes."""
+
+    def __init__(self):
+        self.data = {}
+
+    @staticmethod
+    def _key(key):
+        return key.decode("utf-8") if isinstance(key, bytes) else key
+
+    @staticmethod
+    def _bytes(value):
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode("utf-8")
+
+    def get(self, key):
+        return self.data.get(self._key(key))
+
+    def mget(self, *keys):
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        self.data[self._key(key)] = self._bytes(value)
+
+    def delete(self, *keys):
+        return sum(self.data.pop(self._key(key), None) is not None for key in keys)
+
+    def exists(self, key):
+        return int(self._key(key) in self.data)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        fields = dict(mapping or {})
+        if field is not None:
+            fields[field] = value
+        doc = self.data.setdefault(self._key(key), {})
+        for name, item in fields.items():
+            doc[self._bytes(name)] = self._bytes(item)
+        return len(fields)
+
+    def hget(self, key, field):
+        return self.data.get(self._key(key), {}).get(self._bytes(field))
+
+    def hmget(self, key, *fields):
+        return [self.hget(key, field) for field in fields]
+
+    def hgetall(self, key):
+        return dict(self.data.get(self._key(key), {}))
+
+    def hexists(self, key, field):
+        return self.hget(key, field) is not None
+
+    def hkeys(self, key):
+        return list(self.data.get(self._key(key), {}))
+
+    def hdel(self, key, *fields):
+        doc = self.data.get(self._key(key), {})
+        removed = sum(doc.pop(self._bytes(field), None) is not None for field in fields)
+        if self._key(key) in self.data and not doc:
+            del self.data[self._key(key)]  # Like Redis, an empty hash is deleted
+        return removed
+
+    def hincrby(self, key, field, amount=1):
+        value = int(self.hget(key, field) or 0) + amount
+        self.hset(key, field, value)
+        return value
+
+    def scan_iter(self, match="*", count=None):
+        return [key.encode("utf-8") for key in list(self.data) if fnmatch.fnmatch(key, match)]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def register_script(self, script):
+        assert script == TOUCH_IF_EXISTS, "Only TOUCH_IF_EXISTS is emulated"
+
+        def touch(keys, args, client=None):
+            run = lambda: self.hset(keys[0], args[0], args[1]) if self.exists(keys[0]) else 0
+            if client is None:
+                return run()
+            client.calls.append(run)
+        return touch
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        return lambda *args, **kwargs: self.calls.append(lambda: method(*args, **kwargs))
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        return [call() for call in calls]
+
+class TieringTestCase(unittest.TestCase):
+    """Runs tiering against a temporary archive, the embedded hot backend and an in-memory Redis."""
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.redis = FakeRedis()
+        self.originals = {
+            (helper, "VERSION_CACHE_SECONDS"): helper.VERSION_CACHE_SECONDS,
+            (vector_store, "VECTOR_BACKEND"): vector_store.VECTOR_BACKEND,
+            (vector_store, "VECTOR_DIR"): vector_store.VECTOR_DIR,
+            (tiering, "ARCHIVE_DIR"): tiering.ARCHIVE_DIR,
+            (tiering, "DOCS_FILE"): tiering.DOCS_FILE,
+            (reembed, "VERSION_CACHE_SECONDS"): reembed.VERSION_CACHE_SECONDS,
+        }
+        helper._connections.update(pid=os.getpid(), redis=self.redis, driver=None)
+        helper.VERSION_CACHE_SECONDS = 0
+        helper._version_cache["expires"] = 0
+        vector_store.VECTOR_BACKEND = "embedded"
+        vector_store.VECTOR_DIR = os.path.join(self.path, "vectors")
+        vector_store._backends.clear()
+        tiering.ARCHIVE_DIR = os.path.join(self.path, "archive")
+        tiering.DOCS_FILE = os.path.join(tiering.ARCHIVE_DIR, "docs.jsonl")
+        tiering._cold_stores.clear()
+        tiering._docs_cache = (None, {})
+        reembed.VERSION_CACHE_SECONDS = 0
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        for (module, name), value in self.originals.items():
+            setattr(module, name, value)
+        helper._connections.update(pid=None, redis=None, driver=None)
+        helper._version_cache["expires"] = 0
+        vector_store._backends.clear()
+        tiering._cold_stores.clear()
+        tiering._docs_cache = (None, {})
+        shutil.rmtree(self.path)
+
+    def add_docs(self, count, snippet=True):
+        vectors = self.rng.standard_normal((count, helper.DEFAULT_EMBEDDING_DIM)).astype(np.float32)
+        for i, vector in enumerate(vectors):
+            item = {"title": f"title {i}", "date": "2025-03-23T23:13:29.700Z"}
+            if snippet:
+                item["snippet"] = f"snippet {i}"
+            store_document_in_redis(str(i), item, vector.tobytes())
+        return vectors
+
+class TestTiering(TieringTestCase):
+
+    def test_archive_search_rehydrate(self):
+        vectors = self.add_docs(3)
+        self.assertEqual(tiering.archive_documents([b"doc:0", b"doc:1"]), 2)
+
+        self.assertFalse(self.redis.exists("doc:0"))
+        self.assertEqual(sorted(vector_store.get_vector_backend().keys()), ["doc:2"])
+        self.assertEqual(sorted(tiering.get_cold_store().keys()), ["doc:0", "doc:1"])
+
+        hits = tiering.cold_search_batch([vectors[0], vectors[1]], k=1)
+        self.assertEqual([hits[0][0][0], hits[1][0][0]], ["doc:0", "doc:1"])
+        self.assertAlmostEqual(hits[0][0][1], 0.0, places=2)
+        self.assertEqual(hits[0][0][2]["snippet"], "snippet 0")
+
+        self.assertEqual(tiering.rehydrate_documents(["doc:0"]), 1)
+        self.assertEqual(self.redis.hget("doc:0", "snippet"), b"snippet 0")
+        self.assertIsNotNone(self.redis.hget("doc:0", "last_access"))
+        np.testing.assert_array_equal(vector_store.get_vector_backend().get(["doc:0"])["doc:0"], vectors[0])
+        self.assertEqual(tiering.get_cold_store().keys(), ["doc:1"])
+
+        # Half of the archive is rehydrated: compaction drops those rows from docs.jsonl too
+        tiering.compact_archive()
+        with open(tiering.DOCS_FILE) as f:
+            self.assertEqual([json.loads(line)["id"] for line in f], ["doc:1"])
+        self.assertEqual(tiering.cold_search_batch([vectors[1]], k=1)[0][0][0], "doc:1")
+
+    def test_archive_drops_every_vector_field(self):
+        register_embedding_version("v2", 4, ["http://localhost:1/embedding"])
+        self.redis.set(BUILDING_VERSION_KEY, "v2")
+        self.add_docs(1)
+        vector_store.get_vector_backend("v2").add([("doc:0", np.ones(4, dtype=np.float32))])
+        # A Redis-backend version field holds raw float32 bytes that are not UTF-8
+        self.redis.hset("doc:0", "embedding_v2", np.full(4, -1.5, dtype=np.float32).tobytes())
+
+        self.assertEqual(tiering.archive_documents(["doc:0"]), 1)
+        with open(tiering.DOCS_FILE) as f:
+            row = json.loads(f.readline())
+        self.assertNotIn("embedding_v2", row)
+        self.assertEqual(row["embedding_version"], helper.DEFAULT_EMBEDDING_VERSION)
+        np.testing.assert_array_equal(tiering.get_cold_store("v2").get(["doc:0"])["doc:0"], np.ones(4))
+        self.assertEqual(vector_store.get_vector_backend("v2").keys(), [])
+
+class TestReembed(TieringTestCase):
+
+    def setUp(self):
+        super().setUp()
+        register_embedding_version("v2", 4, ["http://localhost:1/embedding"])
+        self.redis.set(BUILDING_VERSION_KEY, "v2")
+        self.original_embed_texts = reembed.embed_texts
+        self.embedded = []
+        reembed.embed_texts = self.embed_texts
+
+    def tearDown(self):
+        reembed.embed_texts = self.original_embed_texts
+        super().tearDown()
+
+    def embed_texts(self, texts, version):
+        self.embedded += texts
+        return [np.full(4, len(text), dtype=np.float32) for text in texts]
+
+    def test_skips_only_documents_without_snippet(self):
+        self.add_docs(2)
+        self.redis.hdel("doc:1", "snippet")
+        self.assertEqual(reembed.reembed_batch(["doc:0", "doc:1"], "v2"), 1)
+        self.assertEqual(reembed.get_skipped("v2"), {"doc:1": "no snippet"})
+        self.assertEqual(self.redis.hget("doc:0", "embedding_version"), b"v2")
+        self.assertEqual(reembed.find_missing("v2"), ([], []))
+
+    def test_pass_racing_archive(self):
+        self.add_docs(3)
+        # doc:0 is archived before the batch reads it, doc:1 while it is being embedded
+        tiering.archive_documents(["doc:0"])
+
+        def embed_while_archiving(texts, version):
+            tiering.archive_documents(["doc:1"])
+            return self.embed_texts(texts, version)
+        reembed.embed_texts = embed_while_archiving
+
+        self.assertEqual(reembed.reembed_batch(["doc:0", "doc:1", "doc:2"], "v2"), 1)
+        self.assertEqual(reembed.get_skipped("v2"), {})
+        self.assertFalse(self.redis.exists("doc:0"))
+        self.assertFalse(self.redis.exists("doc:1"))  # Not resurrected by the version tag
+        self.assertEqual(vector_store.get_vector_backend("v2").keys(), ["doc:2"])
+
+        # The archived documents are picked up by the cold pass instead
+        reembed.embed_texts = self.embed_texts
+        self.assertEqual(reembed.find_missing("v2"), ([], ["doc:0", "doc:1"]))
+        self.assertEqual(reembed.catch_up("v2", rate=1e9), 2)
+        self.assertEqual(reembed.find_missing("v2"), ([], []))
+        self.assertEqual(sorted(tiering.get_cold_store("v2").keys()), ["doc:0", "doc:1"])
+
+    def test_build_version_switches(self):
+        self.add_docs(2)
+        tiering.archive_documents(["doc:1"])
+        self.assertTrue(reembed.build_version("v2", rate=1e9))
+        self.assertEqual(helper.get_active_version(), "v2")
+        self.assertIsNone(helper.get_building_version())
+        self.assertEqual(vector_store.get_vector_backend("v2").keys(), ["doc:0"])
+        self.assertEqual(tiering.get_cold_store("v2").keys(), ["doc:1"])
+
+    def test_version_names_map_to_distinct_fields(self):
+        self.assertEqual(vector_store.version_field("nomic-embed-v2.1"), "embedding_nomic_embed_v2_1")
+        with self.assertRaises(ValueError):
+            reembed.start("version", 4, ["http://localhost:1/embedding"])
+        register_embedding_version("v2_0", 4, ["http://localhost:1/embedding"])
+        with self.assertRaises(ValueError):
+            reembed.start("v2.0", 4, ["http://localhost:1/embedding"])  # Would share embedding_v2_0
+
+if __name__ == "__main__":
+    unittest.main()
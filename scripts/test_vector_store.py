@@ -0,0 +1,131 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import vector_store
+from vector_store import EmbeddedVectorBackend
+
+DIM = 8
+
+class TestEmbeddedVectorBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = EmbeddedVectorBackend(self.path, dim=DIM)
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def add_random(self, count, prefix="doc"):
+        vectors = self.rng.standard_normal((count, DIM)).astype(np.float32)
+        self.store.add((f"{prefix}:{i}", vector) for i, vector in enumerate(vectors))
+        return vectors
+
+    def test_append_and_search(self):
+        vectors = self.add_random(20)
+        self.assertEqual(self.store.count(), 20)
+        np.testing.assert_array_equal(self.store.get(["doc:3"])["doc:3"], vectors[3])
+        hits = self.store.search_batch([vectors[5]], k=3)[0]
+        self.assertEqual(hits[0][0], "doc:5")
+        self.assertAlmostEqual(hits[0][1], 0.0, places=4)
+
+    def test_delete_and_re_add(self):
+        vectors = self.add_random(10)
+        self.store.delete(["doc:1", "doc:2"])
+        self.assertEqual(self.store.count(), 8)
+        self.assertNotIn("doc:1", self.store.get(["doc:1"]))
+
+        # Re-adding a key replaces its vector instead of duplicating it
+        self.store.add([("doc:3", vectors[0])])
+        self.assertEqual(self.store.count(), 8)
+        np.testing.assert_array_equal(self.store.get(["doc:3"])["doc:3"], vectors[0])
+
+    def test_row_index_follows_appends_and_deletes(self):
+        """The key -> row index, updated incrementally across instances, matches a full scan."""
+        other = EmbeddedVectorBackend(self.path, dim=DIM)
+        expected = {}
+        for round in range(5):
+            store = (self.store, other)[round % 2]
+            vectors = self.rng.standard_normal((20, DIM)).astype(np.float32)
+            items = [(f"doc:{self.rng.integers(30)}", vector) for vector in vectors]
+            store.add(items)
+            expected.update(items)
+            deleted = [f"doc:{i}" for i in self.rng.integers(30, size=5)]
+            store.delete(deleted)
+            for key in deleted:
+                expected.pop(key, None)
+
+            for reader in (self.store, other):
+                ids, vectors_on_disk, live, _ = reader._load()
+                scan = {ids[row]: vectors_on_disk[row] for row in np.flatnonzero(live)}
+                self.assertEqual(sorted(scan), sorted(expected))
+                found = reader.get(list(expected) + ["doc:missing"])
+                self.assertEqual(sorted(found), sorted(expected))
+                for key, vector in expected.items():
+                    np.testing.assert_array_equal(found[key], vector)
+
+    def test_remap_across_instances(self):
+        other = EmbeddedVectorBackend(self.path, dim=DIM)
+        self.add_random(5)
+        self.assertEqual(other.count(), 5)
+        other.add([("doc:new", np.ones(DIM, dtype=np.float32))])
+        other.delete(["doc:0"])
+        self.assertEqual(sorted(self.store.keys()), sorted(["doc:1", "doc:2", "doc:3", "doc:4", "doc:new"]))
+
+    def test_compaction(self):
+        vectors = self.add_random(10)
+        self.store.delete([f"doc:{i}" for i in range(6)])
+        survivors = []
+        self.assertTrue(self.store.compact(on_compact=survivors.append))
+
+        self.assertEqual(survivors, [{"doc:6", "doc:7", "doc:8", "doc:9"}])
+        self.assertTrue(os.path.exists(os.path.join(self.path, "CURRENT")))
+        self.assertFalse(os.path.exists(os.path.join(self.path, "vectors.f32")))  # Old generation removed
+        for i in range(6, 10):
+            np.testing.assert_array_equal(self.store.get([f"doc:{i}"])[f"doc:{i}"], vectors[i])
+
+        # Another instance sees the compacted layout, and later appends and deletes use it
+        other = EmbeddedVectorBackend(self.path, dim=DIM)
+        other.add([("doc:10", vectors[0])])
+        other.delete(["doc:6"])
+        self.assertEqual(sorted(self.store.keys()), ["doc:10", "doc:7", "doc:8", "doc:9"])
+        self.assertTrue(self.store.compact(min_dead_fraction=0.1))
+        self.assertEqual(len(os.listdir(self.path)), 3)  # CURRENT, .lock and one generation
+
+    def test_crashed_compaction_keeps_old_generation(self):
+        self.add_random(4)
+        self.store.delete(["doc:0"])
+        # A compaction that died before switching CURRENT leaves only an orphan directory
+        os.makedirs(os.path.join(self.path, "gen-00000001"))
+        with open(os.path.join(self.path, "gen-00000001", "ids.txt"), "w") as f:
+            f.write("doc:garbage\n")
+        self.assertEqual(sorted(EmbeddedVectorBackend(self.path, dim=DIM).keys()), ["doc:1", "doc:2", "doc:3"])
+        self.assertTrue(self.store.compact(min_dead_fraction=0.1))
+        self.assertEqual(sorted(self.store.keys()), ["doc:1", "doc:2", "doc:3"])
+
+    def test_ivf_matches_exact_search(self):
+        original = vector_store.IVF_MIN_ROWS
+        vector_store.IVF_MIN_ROWS = 100
+        try:
+            centers = self.rng.standard_normal((10, DIM)).astype(np.float32) * 10
+            data = np.repeat(centers, 50, axis=0) + self.rng.standard_normal((500, DIM)).astype(np.float32)
+            self.store.add((f"doc:{i}", vector) for i, vector in enumerate(data))
+            queries = data[::25] + 0.1
+
+            approximate = self.store.search_batch(queries, k=5)
+            self.assertIsNotNone(self.store._centroids)
+            exact = self.store.search_batch(queries, k=5, exact=True)
+            recall = np.mean([
+                len({key for key, _ in a} & {key for key, _ in e}) / 5 for a, e in zip(approximate, exact)
+            ])
+            self.assertGreaterEqual(recall, 0.9)
+            self.assertEqual([hits[0][0] for hits in approximate], [hits[0][0] for hits in exact])
+        finally:
+            vector_store.IVF_MIN_ROWS = original
+
+if __name__ == "__main__":
+    unittest.main()
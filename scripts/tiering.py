@@ -0,0 +1,220 @@
+import gc  # Import garbage collection module
+
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+
+from helper import get_redis, decode_redis_data, get_active_version, get_building_version, get_embedding_version
+from helper import DEFAULT_EMBEDDING_VERSION
+from vector_store import EmbeddedVectorBackend, get_vector_backend
+
+# Configuration
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")  # Cold tier lives here, outside Redis
+DOCS_FILE = os.path.join(ARCHIVE_DIR, "docs.jsonl")  # Metadata of archived docs, one JSON line each (latest wins)
+HOT_HORIZON_DAYS = float(os.getenv("HOT_HORIZON_DAYS", "30"))  # Untouched for this long -> cold
+REDIS_MEMORY_BUDGET_MB = int(os.getenv("REDIS_MEMORY_BUDGET_MB", "0"))  # 0 disables the memory budget
+TIER_BATCH_SIZE = 100
+
+# Cold vectors use the embedded backend, always searched with an exact scan. Each
+# embedding version has its own store; the default version's lives in ARCHIVE_DIR.
+_cold_stores = {}
+_docs_cache = (None, {})
+
+def get_cold_store(version=None):
+    version = version or get_active_version()
+    if version not in _cold_stores:
+        path = ARCHIVE_DIR if version == DEFAULT_EMBEDDING_VERSION else os.path.join(ARCHIVE_DIR, version)
+        _cold_stores[version] = EmbeddedVectorBackend(path, get_embedding_version(version)["dim"])
+    return _cold_stores[version]
+
+def tier_versions():
+    """Versions whose vectors move between tiers: the active one and any being built."""
+    return [version for version in (get_active_version(), get_building_version()) if version]
+
+def _read_docs():
+    """Archived document metadata by doc key, re-read only when docs.jsonl changed."""
+    global _docs_cache
+    try:
+        stat = os.stat(DOCS_FILE)
+    except FileNotFoundError:
+        return {}
+    signature = (stat.st_ino, stat.st_size)
+    if _docs_cache[0] != signature:
+        docs = {}
+        with open(DOCS_FILE) as f:
+            for line in f:
+                row = json.loads(line)
+                docs[row["id"]] = row
+        _docs_cache = (signature, docs)
+    return _docs_cache[1]
+
+def get_last_access(doc_data):
+    """Last access time of a document, falling back to its capture date for older docs."""
+    if "last_access" in doc_data:
+        return float(doc_data["last_access"])
+    try:
+        return datetime.fromisoformat(doc_data.get("date", "").replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return time.time()
+
+def archive_documents(keys):
+    """
+    Move documents from Redis into the cold archive.
+
+    Metadata and vectors are fsynced to disk before the Redis hashes are deleted, so a
+    crash in between leaves a duplicate rather than a lost document. Deleting the hash
+    also drops the document from vector_idx.
+    """
+    keys = [key.decode("utf-8") if isinstance(key, bytes) else key for key in keys]
+    active, *other_versions = tier_versions()
+    vectors = get_vector_backend(active).get(keys)
+
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    docs = pipe.execute()
+
+    rows, items = [], []
+    for key, doc_data in zip(keys, docs):
+        if key not in vectors:
+            continue
+        # Vectors live in `embedding` and `embedding_<version>`; only the version tag is metadata
+        for field in [field for field in doc_data if field.startswith(b"embedding")]:
+            if field != b"embedding_version":
+                del doc_data[field]
+        row = decode_redis_data(doc_data)
+        row["id"] = key
+        rows.append(json.dumps(row))
+        items.append((key, vectors[key]))
+
+    if not rows:
+        return 0
+
+    with get_cold_store(active).lock(exclusive=True):
+        with open(DOCS_FILE, "a") as f:
+            f.writelines(row + "\n" for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+    get_cold_store(active).add(items)
+
+    archived = [key for key, _ in items]
+    for version in other_versions:
+        get_cold_store(version).add(get_vector_backend(version).get(archived).items())
+    for version in tier_versions():
+        get_vector_backend(version).delete(archived)
+    get_redis().delete(*archived)
+    print(f"Archived {len(rows)} documents to the cold tier.")
+    return len(rows)
+
+def cold_search(query_embedding, k=5):
+    """
+    Exact L2 scan over the cold archive.
+
+    Returns up to k (doc_key, score, metadata) tuples, nearest first. Scores are squared
+    L2 distances, matching what vector_idx reports for the hot tier.
+    """
+    return cold_search_batch([query_embedding], k)[0]
+
+def cold_search_batch(query_embeddings, k=5, version=None):
+    """Exact L2 scan over the cold archive for several queries with one distance matrix."""
+    cold_store = get_cold_store(version)
+    results = cold_store.search_batch(query_embeddings, k, exact=True)
+    if not any(results):
+        return results
+    with cold_store.lock():
+        docs = _read_docs()
+    return [[(key, score, docs[key]) for key, score in hits if key in docs] for hits in results]
+
+def rehydrate_documents(keys):
+    """Pull archived documents back into Redis and the hot vector index, then drop their cold rows."""
+    active, *other_versions = tier_versions()
+    vectors = get_cold_store(active).get(keys)
+    if not vectors:
+        return 0
+    with get_cold_store(active).lock():
+        docs = _read_docs()
+
+    pipe = get_redis().pipeline(transaction=False)
+    for key in vectors:
+        mapping = {k: v for k, v in docs.get(key, {}).items() if k != "id"}
+        mapping["last_access"] = str(time.time())
+        pipe.hset(key, mapping=mapping)
+    pipe.execute()
+    get_vector_backend(active).add(vectors.items())
+    for version in other_versions:
+        get_vector_backend(version).add(get_cold_store(version).get(vectors.keys()).items())
+
+    for version in tier_versions():
+        get_cold_store(version).delete(vectors.keys())
+    print(f"Rehydrated {len(vectors)} documents into the hot tier.")
+    return len(vectors)
+
+def compact_archive():
+    """Rewrite the archive without rehydrated rows once they make up half of it."""
+    def rewrite_docs(live_keys):
+        docs = _read_docs()
+        with open(DOCS_FILE + ".tmp", "w") as f:
+            f.writelines(json.dumps(row) + "\n" for key, row in docs.items() if key in live_keys)
+        os.replace(DOCS_FILE + ".tmp", DOCS_FILE)
+
+    active, *other_versions = tier_versions()
+    get_cold_store(active).compact(on_compact=rewrite_docs)
+    for version in other_versions:
+        get_cold_store(version).compact()
+
+def select_cold_documents():
+    """
+    Pick hot documents to evict: everything past HOT_HORIZON_DAYS, then the least
+    recently accessed documents until Redis fits in REDIS_MEMORY_BUDGET_MB.
+    """
+    horizon = time.time() - HOT_HORIZON_DAYS * 86400
+    keys = list(get_redis().scan_iter(match="doc:*", count=1000))
+
+    pipe = get_redis().pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, "last_access", "date")
+    access_times = []
+    for key, (last_access, date) in zip(keys, pipe.execute()):
+        doc_data = decode_redis_data({"date": date or b""})
+        if last_access is not None:
+            doc_data["last_access"] = last_access
+        access_times.append((get_last_access(doc_data), key))
+    access_times.sort()
+
+    cold = [key for accessed, key in access_times if accessed < horizon]
+
+    if REDIS_MEMORY_BUDGET_MB:
+        excess = get_redis().info("memory")["used_memory"] - REDIS_MEMORY_BUDGET_MB * 1024 * 1024
+        warm = access_times[len(cold):]
+        while excess > 0 and warm:
+            _, key = warm.pop(0)
+            excess -= get_redis().memory_usage(key) or 0
+            cold.append(key)
+
+    return cold
+
+def tier_documents():
+    """Run one tiering pass: archive cold documents in batches, then compact."""
+    try:
+        cold = select_cold_documents()
+        archived = 0
+        for i in range(0, len(cold), TIER_BATCH_SIZE):
+            archived += archive_documents(cold[i:i + TIER_BATCH_SIZE])
+        compact_archive()
+        print(f"Tiering pass complete: {archived} documents moved to the cold tier.")
+        return archived
+    finally:
+        gc.collect()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move cold documents out of Redis into the on-disk archive.")
+    parser.add_argument("--interval", type=int, default=0, help="Repeat every N seconds (0 runs once)")
+    args = parser.parse_args()
+
+    while True:
+        tier_documents()
+        if not args.interval:
+            break
+        time.sleep(args.interval)
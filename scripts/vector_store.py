@@ -0,0 +1,501 @@
+import fcntl
+import glob
+import os
+import re
+import shutil
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+from redis.commands.search.field import TextField, TagField, VectorField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+
+from helper import get_redis, knn_query, get_active_version, get_embedding_version
+from helper import DEFAULT_EMBEDDING_VERSION, DEFAULT_EMBEDDING_DIM
+
+# Configuration
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "redis")  # "redis" (Redis Stack vector_idx) or "embedded"
+VECTOR_DIR = os.getenv("VECTOR_DIR", "./vectors")  # Data directory of the embedded backend
+IVF_MIN_ROWS = int(os.getenv("IVF_MIN_ROWS", "20000"))  # Below this the embedded backend always scans exactly
+IVF_PROBES = int(os.getenv("IVF_PROBES", "8"))  # Inverted lists scanned per query
+IVF_TRAIN_SAMPLE = 50000
+
+_backends = {}
+
+def version_field(version):
+    """
+    Hash field holding a non-default version's vectors. RediSearch query syntax treats
+    characters such as '-' and '.' as punctuation, so only [A-Za-z0-9_] are kept.
+    """
+    return "embedding_" + re.sub(r"[^A-Za-z0-9_]", "_", version)
+
+def get_vector_backend(version=None):
+    """
+    Return the configured vector backend holding the vectors of an embedding version
+    (default: the active one). The default version keeps the original `embedding` field,
+    vector_idx and VECTOR_DIR; other versions get their own field, index or subdirectory.
+    """
+    version = version or get_active_version()
+    if version not in _backends:
+        dim = get_embedding_version(version)["dim"]
+        default = version == DEFAULT_EMBEDDING_VERSION
+        if VECTOR_BACKEND == "embedded":
+            _backends[version] = EmbeddedVectorBackend(VECTOR_DIR if default else os.path.join(VECTOR_DIR, version), dim)
+        elif default:
+            _backends[version] = RedisVectorBackend()
+        else:
+            _backends[version] = RedisVectorBackend(f"vector_idx_{version}", version_field(version), dim)
+    return _backends[version]
+
+def squared_l2(queries, matrix):
+    """Squared L2 distance between every query and every row of `matrix`."""
+    distances = (
+        (queries ** 2).sum(axis=1)[:, None]
+        - 2 * queries @ matrix.T
+        + (matrix ** 2).sum(axis=1)[None, :]
+    )
+    return np.maximum(distances, 0)  # Clamp float rounding below zero
+
+class RedisVectorBackend:
+    """
+    Vectors stored in a field (by default `embedding`) of the doc:{id} hashes and
+    searched through a RediSearch HNSW index over that field. Requires Redis Stack.
+    """
+
+    def __init__(self, index_name="vector_idx", field="embedding", dim=DEFAULT_EMBEDDING_DIM):
+        self.index_name = index_name
+        self.field = field
+        self.dim = dim
+        self._index_checked = False
+
+    @property
+    def connection(self):
+        return get_redis()
+
+    def ensure_index(self):
+        """Create the index on first use in this process instead of at import time."""
+        if not self._index_checked:
+            self._index_checked = self.create_index()
+        return self._index_checked
+
+    def create_index(self):
+        """Create the index if needed; returns False if Redis could not be reached."""
+        schema = (
+            TextField("content"),
+            TagField("genre"),
+            VectorField(self.field, "HNSW", {
+                "TYPE": "FLOAT32",
+                "DIM": self.dim,
+                "DISTANCE_METRIC": "L2"
+            })
+        )
+        try:
+            self.connection.ft(self.index_name).create_index(
+                schema,
+                definition=IndexDefinition(
+                    prefix=["doc:"], index_type=IndexType.HASH
+                )
+            )
+        except Exception as e:
+            if "Index already exists" not in str(e):
+                print("Error creating index:", e)
+                return False
+        return True
+
+    def indexing_done(self):
+        """Whether the index has caught up with every hash written so far."""
+        indexing = self.connection.ft(self.index_name).info().get("indexing", 0)
+        return float(indexing.decode("utf-8") if isinstance(indexing, bytes) else indexing) == 0
+
+    def drop(self):
+        """Drop the index and remove this field from every document."""
+        try:
+            self.connection.ft(self.index_name).dropindex(delete_documents=False)
+        except Exception as e:
+            print(f"Could not drop {self.index_name}: {e}")
+        pipe = self.connection.pipeline(transaction=False)
+        for key in self.connection.scan_iter(match="doc:*", count=1000):
+            pipe.hdel(key, self.field)
+        pipe.execute()
+        self._index_checked = False
+
+    def add(self, items):
+        """Store (doc_key, vector) pairs."""
+        self.ensure_index()
+        pipe = self.connection.pipeline(transaction=False)
+        for key, vector in items:
+            pipe.hset(key, self.field, np.asarray(vector, dtype=np.float32).tobytes())
+        pipe.execute()
+
+    def get(self, keys):
+        """Return {doc_key: vector} for the keys that have a vector."""
+        keys = list(keys)
+        pipe = self.connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, self.field)
+        return {key: np.frombuffer(blob, dtype=np.float32) for key, blob in zip(keys, pipe.execute()) if blob}
+
+    def delete(self, keys):
+        pipe = self.connection.pipeline(transaction=False)
+        for key in keys:
+            pipe.hdel(key, self.field)
+        pipe.execute()
+
+    def search_batch(self, query_vectors, k=5):
+        """KNN search for several queries in one pipeline; returns [(doc_key, score), ...] per query."""
+        self.ensure_index()
+        query_args = knn_query(k, self.field).get_args()
+        pipe = self.connection.pipeline(transaction=False)
+        for query_vector in query_vectors:
+            blob = np.asarray(query_vector, dtype=np.float32).tobytes()
+            pipe.execute_command("FT.SEARCH", self.index_name, *query_args, "PARAMS", 2, "vec", blob)
+
+        results = []
+        for raw in pipe.execute():
+            # Raw FT.SEARCH reply: [total, key, [field, value, ...], key, [...], ...]
+            hits = []
+            for i in range(1, len(raw), 2):
+                fields = dict(zip(raw[i + 1][::2], raw[i + 1][1::2]))
+                hits.append((raw[i].decode("utf-8"), float(fields[b"score"])))
+            results.append(hits)
+        return results
+
+class EmbeddedVectorBackend:
+    """
+    In-process vector store: a memory-mapped float32 matrix on disk, searched with NumPy.
+
+    Files in the current generation directory:
+      vectors.f32     row-major float32 matrix, appended to
+      ids.txt         one doc key per line, aligned with the matrix rows
+      tombstones.txt  row numbers that have been deleted
+
+    `path`/CURRENT names the current generation (gen-<n>); without it the files live
+    directly in `path`. Compaction writes a complete new generation and switches CURRENT
+    with a single os.replace, so a crash leaves either the old or the new store intact.
+
+    Every process maps the files read-only and re-maps them when another process has
+    appended, deleted or compacted (detected from file inode and size). Writers take an
+    exclusive fcntl lock, readers a shared one, so workers and the http-server can share
+    one directory. Small stores are scanned exactly; from IVF_MIN_ROWS rows on, searches
+    probe the IVF_PROBES nearest k-means lists unless `exact=True` is passed.
+    """
+
+    def __init__(self, path, dim=DEFAULT_EMBEDDING_DIM):
+        self.path = path
+        self.dim = dim
+        self.manifest_file = os.path.join(path, "CURRENT")
+        self.lock_file = os.path.join(path, ".lock")
+        self._signature = None
+        self._snapshot = None
+        self._centroids = None
+        self._assignments = None
+        self._cache_lock = threading.Lock()  # Guards the cached snapshot between request threads
+        os.makedirs(path, exist_ok=True)
+
+    def ensure_index(self):
+        """Nothing to create; the files are created on first append."""
+        return True
+
+    def indexing_done(self):
+        return True
+
+    def drop(self):
+        """Delete every vector in the store."""
+        with self.lock(exclusive=True):
+            for path in self._store_files(self.path):
+                if os.path.exists(path):
+                    os.remove(path)
+            if os.path.exists(self.manifest_file):
+                os.remove(self.manifest_file)
+            self._remove_generations(keep=None)
+
+    def generation_dir(self):
+        """Directory of the current generation's files."""
+        try:
+            with open(self.manifest_file) as f:
+                return os.path.join(self.path, f.read().strip())
+        except FileNotFoundError:
+            return self.path
+
+    @staticmethod
+    def _store_files(directory):
+        return tuple(os.path.join(directory, name) for name in ("vectors.f32", "ids.txt", "tombstones.txt"))
+
+    @property
+    def vectors_file(self):
+        return self._store_files(self.generation_dir())[0]
+
+    @property
+    def ids_file(self):
+        return self._store_files(self.generation_dir())[1]
+
+    @property
+    def tombstones_file(self):
+        return self._store_files(self.generation_dir())[2]
+
+    def _remove_generations(self, keep):
+        for directory in glob.glob(os.path.join(self.path, "gen-*")):
+            if directory != keep:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        with open(self.lock_file, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _file_signature(self):
+        signature = []
+        for path in self._store_files(self.generation_dir()):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_ino, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def _read_ids(self):
+        if not os.path.exists(self.ids_file):
+            return []
+        with open(self.ids_file) as f:
+            return f.read().splitlines()
+
+    def _load(self):
+        """
+        Return (ids, vectors, live mask, {doc_key: live row}), re-mapping only if the files
+        changed. Caller holds the lock.
+        """
+        with self._cache_lock:
+            return self._load_snapshot()
+
+    def _load_snapshot(self):
+        signature = self._file_signature()
+        if signature == self._signature:
+            return self._snapshot
+
+        ids = self._read_ids()
+        rows = os.path.getsize(self.vectors_file) // (4 * self.dim) if os.path.exists(self.vectors_file) else 0
+        rows = min(rows, len(ids))  # A partially written append is ignored until repaired
+        if rows:
+            vectors = np.memmap(self.vectors_file, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        else:
+            vectors = np.empty((0, self.dim), dtype=np.float32)
+
+        live = np.ones(rows, dtype=bool)
+        if os.path.exists(self.tombstones_file):
+            with open(self.tombstones_file) as f:
+                dead = [int(line) for line in f if line.strip()]
+            live[[row for row in dead if row < rows]] = False
+
+        # A new vectors.f32 inode means the file was compacted and row numbers changed
+        previous_rows = len(self._snapshot[0]) if self._snapshot else 0
+        old_inode = self._signature[0][0] if self._signature and self._signature[0] else None
+        compacted = old_inode is not None and (signature[0] is None or signature[0][0] != old_inode)
+        if compacted or rows < previous_rows:
+            previous_rows = 0
+        ids = ids[:rows]
+        self._snapshot = (ids, vectors, live, self._index_rows(ids, live, previous_rows))
+        self._signature = signature
+        self._update_ivf(vectors, previous_rows)
+        return self._snapshot
+
+    def _index_rows(self, ids, live, previous_rows):
+        """
+        Map each doc key to its live row. The previous snapshot's map is updated with the
+        rows appended and tombstoned since, so a large store is not re-indexed per change.
+        """
+        if not previous_rows:
+            return {ids[row]: row for row in np.flatnonzero(live)}
+        _, _, previous_live, previous_index = self._snapshot
+        index = previous_index.copy()  # Readers of the previous snapshot keep theirs intact
+        for row in np.flatnonzero(previous_live & ~live[:previous_rows]):
+            if index.get(ids[row]) == row:
+                del index[ids[row]]
+        for row in np.flatnonzero(live[previous_rows:]) + previous_rows:
+            index[ids[row]] = row
+        return index
+
+    def _repair(self):
+        """Trim a torn append so vectors and ids stay row-aligned. Caller holds the exclusive lock."""
+        ids = self._read_ids()
+        size = os.path.getsize(self.vectors_file) if os.path.exists(self.vectors_file) else 0
+        rows = min(size // (4 * self.dim), len(ids))
+        if size != rows * 4 * self.dim:
+            with open(self.vectors_file, "r+b") as f:
+                f.truncate(rows * 4 * self.dim)
+        if len(ids) != rows:
+            with open(self.ids_file, "w") as f:
+                f.writelines(doc_id + "\n" for doc_id in ids[:rows])
+        return rows
+
+    def _append_tombstones(self, rows):
+        with open(self.tombstones_file, "a") as f:
+            f.writelines(f"{row}\n" for row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, items):
+        """Append (doc_key, vector) pairs. Re-adding a key tombstones its previous row."""
+        items = list(dict(items).items())  # One row per key, the last vector wins
+        if not items:
+            return
+        matrix = np.vstack([np.asarray(vector, dtype=np.float32).reshape(-1) for _, vector in items])
+        if matrix.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional vectors, got {matrix.shape[1]}")
+
+        with self.lock(exclusive=True):
+            rows = self._repair()
+            self._delete_locked([key for key, _ in items])
+
+            with open(self.vectors_file, "ab") as f:
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.ids_file, "a") as f:
+                f.writelines(key + "\n" for key, _ in items)
+                f.flush()
+                os.fsync(f.fileno())
+        print(f"Appended {len(items)} vectors at row {rows}.")
+
+    def _delete_locked(self, keys):
+        index = self._load()[3]
+        dead = sorted({index[key] for key in keys if key in index})
+        if dead:
+            self._append_tombstones(dead)
+        return len(dead)
+
+    def delete(self, keys):
+        """Tombstone the rows of the given doc keys; space is reclaimed by compact()."""
+        with self.lock(exclusive=True):
+            return self._delete_locked(keys)
+
+    def get(self, keys):
+        """Return {doc_key: vector} for the keys that have a live row."""
+        with self.lock():
+            _, vectors, _, index = self._load()
+            return {key: np.array(vectors[index[key]]) for key in set(keys) if key in index}
+
+    def count(self):
+        with self.lock():
+            return int(self._load()[2].sum())
+
+    def keys(self):
+        with self.lock():
+            return list(self._load()[3])
+
+    def search_batch(self, query_vectors, k=5, exact=False):
+        """Nearest neighbours by squared L2 distance; returns [(doc_key, score), ...] per query, nearest first."""
+        if len(query_vectors) == 0:
+            return []
+        queries = np.vstack([np.asarray(q, dtype=np.float32).reshape(-1) for q in query_vectors])
+
+        with self.lock():
+            ids, vectors, live, _ = self._load()
+            if not live.any():
+                return [[] for _ in queries]
+
+            if exact or self._centroids is None:
+                # Exact scan: one distance matrix for the whole batch
+                candidates = np.flatnonzero(live)
+                distance_rows = squared_l2(queries, np.asarray(vectors[candidates]))
+                pairs = [(candidates, distances) for distances in distance_rows]
+            else:
+                # IVF: scan only the rows in each query's nearest lists
+                probes = np.argsort(squared_l2(queries, self._centroids), axis=1)[:, :IVF_PROBES]
+                pairs = []
+                for query, probe in zip(queries, probes):
+                    candidates = np.flatnonzero(live & np.isin(self._assignments, probe))
+                    pairs.append((candidates, squared_l2(query[None, :], np.asarray(vectors[candidates]))[0]))
+
+            results = []
+            for candidates, distances in pairs:
+                top = np.argsort(distances)[:k]
+                results.append([(ids[candidates[i]], float(distances[i])) for i in top])
+            return results
+
+    def _update_ivf(self, vectors, previous_rows):
+        """Train k-means lists once the store is large enough, then assign new rows incrementally."""
+        rows = len(vectors)
+        if rows < IVF_MIN_ROWS:
+            self._centroids = self._assignments = None
+            return
+
+        if self._centroids is None or previous_rows == 0:
+            nlist = int(np.sqrt(rows))
+            sample = np.random.default_rng(0).choice(rows, min(rows, IVF_TRAIN_SAMPLE), replace=False)
+            self._centroids = kmeans(np.asarray(vectors[np.sort(sample)]), nlist)
+            self._assignments = nearest_centroid(vectors, self._centroids)
+        elif rows > previous_rows:
+            self._assignments = np.concatenate([
+                self._assignments, nearest_centroid(vectors[previous_rows:], self._centroids)
+            ])
+
+    def compact(self, min_dead_fraction=0.5, on_compact=None):
+        """
+        Rewrite the store without tombstoned rows once they make up `min_dead_fraction` of it.
+        `on_compact` is called with the set of surviving keys while the exclusive lock is held.
+        """
+        with self.lock(exclusive=True):
+            ids, vectors, live, _ = self._load()
+            if len(live) == 0 or (~live).mean() < min_dead_fraction:
+                return False
+
+            # Write the new generation completely (and durably) before pointing CURRENT at it
+            old_dir = self.generation_dir()
+            number = int(os.path.basename(old_dir)[len("gen-"):]) if old_dir != self.path else 0
+            generation = f"gen-{number + 1:08d}"
+            new_dir = os.path.join(self.path, generation)
+            shutil.rmtree(new_dir, ignore_errors=True)  # Leftover of a compaction that crashed
+            os.makedirs(new_dir)
+
+            kept = np.flatnonzero(live)
+            vectors_file, ids_file, tombstones_file = self._store_files(new_dir)
+            with open(vectors_file, "wb") as f:
+                f.write(np.asarray(vectors[kept], dtype=np.float32).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(ids_file, "w") as f:
+                f.writelines(ids[row] + "\n" for row in kept)
+                f.flush()
+                os.fsync(f.fileno())
+            open(tombstones_file, "w").close()
+
+            with open(self.manifest_file + ".tmp", "w") as f:
+                f.write(generation)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.manifest_file + ".tmp", self.manifest_file)  # The commit point
+
+            if on_compact:
+                on_compact({ids[row] for row in kept})
+
+            # The old generation is garbage now; a crash here only leaves files behind
+            if old_dir == self.path:
+                for path in self._store_files(self.path):
+                    if os.path.exists(path):
+                        os.remove(path)
+            self._remove_generations(keep=new_dir)
+            print(f"Compacted {self.path} to {len(kept)} vectors.")
+            return True
+
+def nearest_centroid(vectors, centroids, chunk_size=10000):
+    """Index of the nearest centroid for every row, computed in chunks to bound memory."""
+    return np.concatenate([
+        np.argmin(squared_l2(np.asarray(vectors[i:i + chunk_size]), centroids), axis=1)
+        for i in range(0, len(vectors), chunk_size)
+    ]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+def kmeans(data, nlist, iterations=10):
+    """Plain Lloyd's k-means used to build the IVF lists."""
+    centroids = data[np.random.default_rng(0).choice(len(data), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroid(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, data)
+        counts = np.bincount(assignments, minlength=nlist)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    return centroids
@@ -1,66 +1,60 @@
 import gc  # Import garbage collection module
 
 # Other imports remain the same
-from redis import Redis
-from redis.commands.search.field import TextField, TagField, VectorField
-from redis.commands.search.indexDefinition import IndexDefinition, IndexType
-from rq import Queue, Retry
-from neo4j import GraphDatabase
+from rq import Retry
+import argparse
 import re
 import requests
 import uuid
 import json
 import os
+import time
 from retry import retry
 import numpy as np
 
-from helper import decode_redis_data, store_document_in_redis, save_to_local_file
+from helper import decode_redis_data, store_document_in_redis, save_to_local_file, enqueue_stage
+from helper import get_redis, get_driver, STAGES, BACKFILL_SUFFIX, DEFERRED_SUFFIX
+from helper import track_stage, fail_capture, set_capture_documents, finish_capture_document
+from helper import get_active_version, get_embedding_pool, parse_embeddings, store_building_vectors
+from vector_store import get_vector_backend
 
 # Configuration
-EMBEDDING_SERVER = "http://localhost:8000/embedding"  # Llama-cpp endpoint
-REDIS_HOST = "localhost"
-REDIS_PORT = 6379
 VECTOR_STORE = "vectors.json"  # Local storage for embeddings (replace with DB if needed)
 ENTITY_STORE = "entities.json"  # Local storage for entities (replace with DB if needed)
-NEO4J_URI = "bolt://localhost:7687"  # Neo4j URI
-neo4j_username = os.getenv("NEO4J_USERNAME", "neo4j")
-neo4j_password = os.getenv("NEO4J_PASSWORD", "password")  # Default password, change as needed
-
-redis_conn = Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=False)
-driver = GraphDatabase.driver(NEO4J_URI, auth=(neo4j_username, neo4j_password))
-        
-schema = (
-    TextField("content"),
-    TagField("genre"),
-    VectorField("embedding", "HNSW", {
-        "TYPE": "FLOAT32",
-        "DIM": 768,
-        "DISTANCE_METRIC": "L2"
-    })
-)
-
-try:
-    redis_conn.ft("vector_idx").create_index(
-        schema,
-        definition=IndexDefinition(
-            prefix=["doc:"], index_type=IndexType.HASH
-        )
-    )
-except Exception as e:
-    if "Index already exists" not in str(e):
-        print("Error creating index:", e)
-
-def embed_snippet(data, timestamp, test=False):
-    """Processes the snippet data: gets embeddings, stores them, and enqueues an extraction task."""
+# Opt-in fused mode: captures up to this size run as a single job. Fused jobs load Neo4j
+# from the extract pool, bypassing the small load pool, so it is off (0) by default.
+FUSED_MAX_CHARS = int(os.getenv("FUSED_MAX_CHARS", "0"))
+
+def document_id(capture_id, index):
+    """
+    ID of the index-th document of a capture. It is derived from the capture ID, so
+    replaying a capture from the ingest log overwrites its documents instead of
+    duplicating them.
+    """
+    if not capture_id:
+        return str(uuid.uuid4())
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"capture:{capture_id}/{index}"))
+
+def embed_snippet(data, timestamp, test=False, backfill=False, capture_id=None):
+    """Processes the snippet data: gets embeddings, stores them, and enqueues an extraction task.
+
+    Set `backfill` for historical imports so every stage runs them behind fresh captures.
+    `capture_id` ties every stage of this capture together for progress tracking.
+    """
     try:
-        snippets = [item["snippet"] for item in data if "snippet" in item and item["snippet"].strip()]
+        track_stage(capture_id, "embed", "started")
+        items = [item for item in data if "snippet" in item and item["snippet"].strip()]
+        snippets = [item["snippet"] for item in items]
 
         if not snippets:
             print(f"[{timestamp}] No valid snippets found. Skipping processing.")
+            track_stage(capture_id, "embed", "finished")
+            set_capture_documents(capture_id, 0)
             return
 
+        version = get_active_version()
         try:
-            response = requests.post(EMBEDDING_SERVER, json={"content": snippets})
+            response = get_embedding_pool(version).post(json={"content": snippets})
             response.raise_for_status()  # Raises exception for 4xx/5xx errors
         except requests.exceptions.HTTPError as http_err:
             print(f"HTTP error: {http_err}")
@@ -68,9 +62,10 @@ def embed_snippet(data, timestamp, test=False):
             print(f"Connection error: {conn_err}")
 
         if response.status_code == 200:
-            embeddings = [item['embedding'][0] for item in response.json()]
+            embeddings = [embedding.tolist() for embedding in parse_embeddings(response)]
             if len(embeddings) != len(snippets):
                 print(f"[{timestamp}] Warning: Mismatch between snippets and embeddings count!")
+                fail_capture(capture_id, "embed")
                 return
 
             processed_data = [
@@ -79,21 +74,27 @@ def embed_snippet(data, timestamp, test=False):
                     "snippet": item["snippet"],
                     "embedding": embedding
                 }
-                for item, embedding in zip(data, embeddings)
+                for item, embedding in zip(items, embeddings)
             ]
 
+            set_capture_documents(capture_id, len(processed_data))
+
+            for index, item in enumerate(processed_data):
+                item["id"] = document_id(capture_id, index)
+            store_building_vectors([f"doc:{item['id']}" for item in processed_data], snippets)
+
             for item in processed_data:
-                doc_id = str(uuid.uuid4())
-                item["id"] = doc_id
+                doc_id = item["id"]
                 embedding_bytes = np.array(item["embedding"], dtype=np.float32).tobytes()
-                store_document_in_redis(doc_id, item, embedding_bytes)
+                store_document_in_redis(doc_id, item, embedding_bytes, version)
 
                 if test:
                     return doc_id
                 else:
-                    queue = Queue("snippet_queue", connection=redis_conn)
-                    queue.enqueue(extract_snippet, {"doc_id": doc_id}, retry=Retry(max=3, interval=[10, 30, 60]))  # Retry 3 times with increasing delay
+                    enqueue_stage("extract", extract_snippet, args=({"doc_id": doc_id, "backfill": backfill, "capture_id": capture_id},),
+                                  backfill=backfill, retry=Retry(max=3, interval=[10, 30, 60]))  # Retry 3 times with increasing delay
 
+            track_stage(capture_id, "embed", "finished")
             if not test:
                 # Save the processed data to a local file
                 save_to_local_file(VECTOR_STORE, {"timestamp": timestamp, "data": processed_data})
@@ -101,48 +102,55 @@ def embed_snippet(data, timestamp, test=False):
 
         else:
             print(f"[{timestamp}] Embedding server error: {response.status_code} - {response.text}")
+            fail_capture(capture_id, "embed")
 
     except Exception as e:
         print(f"[{timestamp}] Error processing snippet: {e}")
+        fail_capture(capture_id, "embed")
         if test:
             # throw an exception to indicate failure
             raise Exception(f"Failed to process snippet data: {e}")
     finally:
-        redis_conn.close()
-        print("Redis connection closed.")
         gc.collect()  # Trigger garbage collection
 
+def extract_relations(snippet):
+    """Run information extraction on a snippet and return JSON-ready (relations, named_entities)."""
+    from information_extractor.main import extract_information
+
+    relations, named_entities = extract_information(snippet)
+
+    # print total keys in relations and named_entities
+    print(f"Total relations: {len(relations)}")
+    print(f"Total named_entities: {len(named_entities)}")
+
+    relations_dict = {f"{s}||{r}||{o}": float(c) for (s, r, o), c in relations.items()}
+    named_entities_list = {k: list(v) if isinstance(v, set) else v for k, v in named_entities.items()}
+    return relations_dict, named_entities_list
+
 @retry((requests.exceptions.RequestException, SystemExit), tries=3, delay=5)
 def extract_snippet(task_payload, test=False):
     """Processes a task from the queue by extracting information."""
+    capture_id = task_payload.get("capture_id")
     try:
+        track_stage(capture_id, "extract", "started")
         doc_id = task_payload.get("doc_id")
 
         if not doc_id:
             print("Invalid task payload, missing 'doc_id'")
-            return
+            raise ValueError("missing 'doc_id'")
 
-        doc_data = redis_conn.hgetall(f"doc:{doc_id}")
+        doc_data = get_redis().hgetall(f"doc:{doc_id}")
         doc_data = decode_redis_data(doc_data)
         
         if not doc_data or "snippet" not in doc_data:
             print(f"Document {doc_id} not found or missing snippet.")
-            return
+            raise ValueError(f"document {doc_id} not found or missing snippet")
         
         snippet = doc_data["snippet"]
 
-        from information_extractor.main import extract_information
-
-        relations, named_entities = extract_information(snippet)
-
-        # print total keys in relations and named_entities
-        print(f"Total relations: {len(relations)}")
-        print(f"Total named_entities: {len(named_entities)}")
-
-        relations_dict = {f"{s}||{r}||{o}": float(c) for (s, r, o), c in relations.items()}
-        named_entities_list = {k: list(v) if isinstance(v, set) else v for k, v in named_entities.items()}
+        relations_dict, named_entities_list = extract_relations(snippet)
         
-        redis_conn.hset(f"doc:{doc_id}", mapping={
+        get_redis().hset(f"doc:{doc_id}", mapping={
             "relations": json.dumps(relations_dict),
             "named_entities": json.dumps(named_entities_list)
         })
@@ -151,32 +159,105 @@ def extract_snippet(task_payload, test=False):
             save_to_local_file(ENTITY_STORE, {"doc_id": doc_id, "relations": relations_dict, "named_entities": named_entities_list})
 
         print(f"Extraction completed for document {doc_id}")
+        track_stage(capture_id, "extract", "finished")
         
         if test:
             return doc_id
         else:
             # Enqueue the next task to load the snippet into Neo4j
-            queue = Queue("snippet_queue", connection=redis_conn)
-            queue.enqueue(load_snippet, {"doc_id": doc_id})
+            backfill = task_payload.get("backfill", False)
+            enqueue_stage("load", load_snippet, args=({"doc_id": doc_id, "backfill": backfill, "capture_id": capture_id},), backfill=backfill)
     
     except Exception as e:
         print(f"Error extracting information on line {e.__traceback__.tb_lineno}: {e}")
+        track_stage(capture_id, "extract", "failed")
+        finish_capture_document(capture_id, failed=True)
         if test:
             # throw an exception to indicate failure
             raise Exception(f"Failed to extract information for doc ID: {doc_id}")
     finally:
-        redis_conn.close()
-        print("Redis connection closed.")
         gc.collect()  # Trigger garbage collection
 
+def format_relationship_name(rel_name):
+    return re.sub(r'[_-]', ' ', rel_name).title()
+
+def add_entities_and_relations(tx, doc_id, title, url, date, named_entities, relations):
+    # Create or update Document node
+    tx.run("""
+        MERGE (d:Document {doc_id: $doc_id})
+        SET d.title = $title, d.url = $url, d.date = $date
+    """, doc_id=doc_id, title=title, url=url, date=date)
+
+    entity_label_map = {
+        "PERSON": "Person",
+        "ORG": "Organization",
+        "DATE": "Date",
+        "CARDINAL": "Number",
+        "GPE": "GeopoliticalEntity",
+        "NORP": "Group",
+        "FAC": "Facility",
+        "LOC": "Location",
+        "EVENT": "Event",
+        "WORK_OF_ART": "Work",
+        "LAW": "Law",
+        "PRODUCT": "Product"
+    }
+
+    # Add global entities and connect to Document
+    for entity_type, texts in named_entities.items():
+        label = entity_label_map.get(entity_type, "Entity")
+        for text in texts:
+            entity_query = f"""
+            MERGE (e:{label} {{text: $text, type: $entity_type}})
+            """
+            tx.run(entity_query, text=text, entity_type=entity_type)
+
+            mentions_query = f"""
+            MATCH (d:Document {{doc_id: $doc_id}})
+            MATCH (e:{label} {{text: $text, type: $entity_type}})
+            MERGE (d)-[:MENTIONS]->(e)
+            """
+            tx.run(mentions_query, doc_id=doc_id, text=text, entity_type=entity_type)
+
+    # Add relationships between entities (deduped across docs)
+    for key, confidence in relations.items():
+        parts = key.split("||")
+        if len(parts) != 3:
+            print(f"Skipping invalid relation key: {key}")
+            continue
+
+        subject, relation, object_ = parts
+        clean_relation = relation.split(":", 1)[-1] if ":" in relation else relation
+        formatted_relation = format_relationship_name(clean_relation)
+
+        relation_query = f"""
+        MATCH (s {{text: $subject}})
+        MATCH (o {{text: $object}})
+        MERGE (s)-[r:`{formatted_relation}`]->(o)
+        ON CREATE SET r.confidence = $confidence, r.relation_tuple = $relation_tuple, r.docs = [$doc_id]
+        ON MATCH SET r.confidence = (r.confidence + $confidence) / 2,
+                      r.docs = CASE WHEN $doc_id IN r.docs THEN r.docs ELSE r.docs + $doc_id END
+        """
+
+        tx.run(
+            relation_query,
+            subject=subject,
+            object=object_,
+            confidence=confidence,
+            doc_id=doc_id,
+            relation_tuple=key
+        )
+
 def load_snippet(task_payload, test=False):
+    capture_id = task_payload.get("capture_id")
     try:
+        track_stage(capture_id, "load", "started")
         doc_id = task_payload.get("doc_id")
         if not doc_id:
             print("Invalid task payload, missing 'doc_id'")
-            return
+            raise ValueError("missing 'doc_id'")
 
-        doc_data = redis_conn.hgetall(f"doc:{doc_id}")
+        doc_data = get_redis().hgetall(f"doc:{doc_id}")
         doc_data = decode_redis_data(doc_data)
 
         named_entities_str = doc_data.get("named_entities")
@@ -186,92 +267,166 @@ def load_snippet(task_payload, test=False):
         relations_str = doc_data.get("relations")
         if not named_entities_str or not relations_str:
             print(f"Document {doc_id} is missing named entities or relations.")
-            return
+            raise ValueError(f"document {doc_id} is missing named entities or relations")
 
         named_entities = json.loads(named_entities_str)
         relations = json.loads(relations_str)
 
-        def format_relationship_name(rel_name):
-            return re.sub(r'[_-]', ' ', rel_name).title()
-
-        def add_entities_and_relations(tx, doc_id, title, url, date, named_entities, relations):
-            # Create or update Document node
-            tx.run("""
-                MERGE (d:Document {doc_id: $doc_id})
-                SET d.title = $title, d.url = $url, d.date = $date
-            """, doc_id=doc_id, title=title, url=url, date=date)
-
-            entity_label_map = {
-                "PERSON": "Person",
-                "ORG": "Organization",
-                "DATE": "Date",
-                "CARDINAL": "Number",
-                "GPE": "GeopoliticalEntity",
-                "NORP": "Group",
-                "FAC": "Facility",
-                "LOC": "Location",
-                "EVENT": "Event",
-                "WORK_OF_ART": "Work",
-                "LAW": "Law",
-                "PRODUCT": "Product"
-            }
-
-            # Add global entities and connect to Document
-            for entity_type, texts in named_entities.items():
-                label = entity_label_map.get(entity_type, "Entity")
-                for text in texts:
-                    entity_query = f"""
-                    MERGE (e:{label} {{text: $text, type: $entity_type}})
-                    """
-                    tx.run(entity_query, text=text, entity_type=entity_type)
-
-                    mentions_query = f"""
-                    MATCH (d:Document {{doc_id: $doc_id}})
-                    MATCH (e:{label} {{text: $text, type: $entity_type}})
-                    MERGE (d)-[:MENTIONS]->(e)
-                    """
-                    tx.run(mentions_query, doc_id=doc_id, text=text, entity_type=entity_type)
-
-            # Add relationships between entities (deduped across docs)
-            for key, confidence in relations.items():
-                parts = key.split("||")
-                if len(parts) != 3:
-                    print(f"Skipping invalid relation key: {key}")
-                    continue
-
-                subject, relation, object_ = parts
-                clean_relation = relation.split(":", 1)[-1] if ":" in relation else relation
-                formatted_relation = format_relationship_name(clean_relation)
-
-                relation_query = f"""
-                MATCH (s {{text: $subject}})
-                MATCH (o {{text: $object}})
-                MERGE (s)-[r:`{formatted_relation}`]->(o)
-                ON CREATE SET r.confidence = $confidence, r.relation_tuple = $relation_tuple, r.docs = [$doc_id]
-                ON MATCH SET r.confidence = (r.confidence + $confidence) / 2,
-                              r.docs = CASE WHEN $doc_id IN r.docs THEN r.docs ELSE r.docs + $doc_id END
-                """
-
-                tx.run(
-                    relation_query,
-                    subject=subject,
-                    object=object_,
-                    confidence=confidence,
-                    doc_id=doc_id,
-                    relation_tuple=key
-                )
-
-        with driver.session() as session:
+        with get_driver().session() as session:
             session.execute_write(add_entities_and_relations, doc_id, title, url, date, named_entities, relations)
             print(f"Loaded snippet {doc_id} into Neo4j successfully.")
 
+        track_stage(capture_id, "load", "finished")
+        finish_capture_document(capture_id)
+
     except Exception as e:
         print(f"Error loading snippet into Neo4j on line {e.__traceback__.tb_lineno}: {e}")
+        track_stage(capture_id, "load", "failed")
+        finish_capture_document(capture_id, failed=True)
         if test:
             raise Exception(f"Failed to load snippet into Neo4j for doc ID: {doc_id}")
     finally:
-        redis_conn.close()
-        print("Redis connection closed.")
-        driver.close()
-        print("Neo4j driver closed.")
         gc.collect()
+
+def should_fuse(data):
+    """With fused mode on, small captures are cheaper to run as one job than as three queued stages."""
+    total_chars = sum(len(item.get("snippet", "")) for item in data)
+    return 0 < total_chars <= FUSED_MAX_CHARS
+
+def ingest_snippets(data, timestamp, backfill=False, capture_id=None):
+    """
+    Fused pipeline: embed -> extract -> load for a batch of snippets inside one job.
+
+    Documents stay in memory between stages: one embedding request for the batch, one
+    Redis pipeline for all writes and one Neo4j session for all loads. Any stage that
+    fails hands its documents back to the staged path (embed_snippet, extract_snippet
+    or load_snippet), so retries stay per-stage.
+    """
+    try:
+        items = [item for item in data if "snippet" in item and item["snippet"].strip()]
+
+        if not items:
+            print(f"[{timestamp}] No valid snippets found. Skipping processing.")
+            set_capture_documents(capture_id, 0)
+            return
+
+        # Stage 1: embed the whole batch in one request
+        track_stage(capture_id, "embed", "started")
+        version = get_active_version()
+        try:
+            response = get_embedding_pool(version).post(json={"content": [item["snippet"] for item in items]})
+            response.raise_for_status()
+            embeddings = [embedding.tolist() for embedding in parse_embeddings(response)]
+            if len(embeddings) != len(items):
+                raise ValueError("Mismatch between snippets and embeddings count")
+        except Exception as e:
+            print(f"[{timestamp}] Fused embedding failed ({e}), falling back to staged ingest.")
+            enqueue_stage("embed", embed_snippet, args=(items, timestamp), kwargs={"capture_id": capture_id},
+                          backfill=backfill)
+            return
+        track_stage(capture_id, "embed", "finished")
+
+        # Stage 2: extract in memory, then write each document to Redis once
+        docs = []
+        pipe = get_redis().pipeline(transaction=False)
+        for index, (item, embedding) in enumerate(zip(items, embeddings)):
+            doc = {
+                **{k: item[k] for k in ['date', 'title', 'url'] if k in item},
+                "snippet": item["snippet"],
+                "id": document_id(capture_id, index)
+            }
+            try:
+                track_stage(capture_id, "extract", "started")
+                doc["relations"], doc["named_entities"] = extract_relations(doc["snippet"])
+                track_stage(capture_id, "extract", "finished")
+            except Exception as e:
+                print(f"Fused extraction failed for document {doc['id']}: {e}")
+
+            mapping = {k: json.dumps(v) if isinstance(v, dict) else str(v) for k, v in doc.items()}
+            mapping["last_access"] = str(time.time())
+            mapping["embedding_version"] = version
+            pipe.hset(f"doc:{doc['id']}", mapping=mapping)
+            docs.append(doc)
+        pipe.execute()
+        get_vector_backend(version).add([
+            (f"doc:{doc['id']}", np.array(embedding, dtype=np.float32)) for doc, embedding in zip(docs, embeddings)
+        ])
+        store_building_vectors([f"doc:{doc['id']}" for doc in docs], [doc["snippet"] for doc in docs])
+
+        save_to_local_file(VECTOR_STORE, {"timestamp": timestamp, "data": [
+            {**doc, "embedding": embedding} for doc, embedding in zip(docs, embeddings)
+        ]})
+        set_capture_documents(capture_id, len(docs))
+
+        for doc in docs:
+            if "relations" not in doc:
+                enqueue_stage("extract", extract_snippet, args=({"doc_id": doc["id"], "backfill": backfill, "capture_id": capture_id},),
+                              backfill=backfill, retry=Retry(max=3, interval=[10, 30, 60]))
+            else:
+                save_to_local_file(ENTITY_STORE, {"doc_id": doc["id"], "relations": doc["relations"], "named_entities": doc["named_entities"]})
+
+        # Stage 3: load every extracted document through a single Neo4j session
+        with get_driver().session() as session:
+            for doc in docs:
+                if "relations" not in doc:
+                    continue
+                try:
+                    track_stage(capture_id, "load", "started")
+                    session.execute_write(add_entities_and_relations, doc["id"], doc.get("title", ""), doc.get("url", ""),
+                                          doc.get("date", ""), doc["named_entities"], doc["relations"])
+                    print(f"Loaded snippet {doc['id']} into Neo4j successfully.")
+                    track_stage(capture_id, "load", "finished")
+                    finish_capture_document(capture_id)
+                except Exception as e:
+                    print(f"Fused load failed for document {doc['id']} ({e}), falling back to staged load.")
+                    enqueue_stage("load", load_snippet, args=({"doc_id": doc["id"], "backfill": backfill, "capture_id": capture_id},), backfill=backfill)
+
+        print(f"[{timestamp}] Fused ingest processed {len(docs)} snippets.")
+        return [doc["id"] for doc in docs]
+
+    except Exception as e:
+        print(f"[{timestamp}] Error in fused ingest on line {e.__traceback__.tb_lineno}: {e}")
+        fail_capture(capture_id, "ingest")
+        raise
+    finally:
+        gc.collect()
+
+def enqueue_capture(data, timestamp, capture_id, backfill=False):
+    """
+    Enqueue a capture's first job under the capture ID. With FUSED_MAX_CHARS set, small
+    captures run as one fused job on the extract pool (it does the CPU-heavy work);
+    everything else goes through the staged queues.
+    """
+    stage, func = ("extract", ingest_snippets) if should_fuse(data) else ("embed", embed_snippet)
+    return enqueue_stage(stage, func, args=(data, timestamp), kwargs={"capture_id": capture_id},
+                         backfill=backfill, job_id=capture_id)
+
+def warm_up(stage):
+    """
+    Do a stage's one-time setup in the parent worker process, so every forked work
+    horse inherits it instead of repeating it per job.
+    """
+    if stage in ("embed", "extract"):
+        get_vector_backend().ensure_index()
+    if stage == "extract":
+        # Extraction (and fused ingest) load the spaCy pipeline; import it once here.
+        # Without it the worker still starts and each job reports the import error.
+        try:
+            from information_extractor.main import extract_information
+        except ImportError as e:
+            print(f"Could not preload the information extractor, jobs will retry the import: {e}")
+    get_redis().ping()
+    print(f"Worker for stage '{stage}' is warm.")
+
+if __name__ == "__main__":
+    from rq import Worker
+
+    parser = argparse.ArgumentParser(description="Run a warmed-up RQ worker for one ingest stage.")
+    parser.add_argument("stage", choices=list(STAGES), help="Stage whose queues this worker serves")
+    args = parser.parse_args()
+
+    warm_up(args.stage)
+    queue_name = STAGES[args.stage]["queue"]
+    # Releasing deferred jobs is cheap and must not wait behind a long backfill queue
+    queues = [queue_name, queue_name + DEFERRED_SUFFIX, queue_name + BACKFILL_SUFFIX]
+    Worker(queues, connection=get_redis()).work(with_scheduler=True)
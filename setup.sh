@@ -124,23 +124,58 @@ box download_file "https://huggingface.co/nomic-ai/nomic-embed-text-v1.5-GGUF/re
 box log_info "Downloading bge-reranker-v2-m3 Model..."
 box download_file "https://huggingface.co/gpustack/bge-reranker-v2-m3-GGUF/resolve/main/bge-reranker-v2-m3-Q2_K.gguf" "$HOME/$MODEL_DIR/bge-reranker-v2-m3-Q2_K.gguf"
 
-# 5. Create and start llama-server service
+# 5. Create and start the model servers
+# Each role runs a pool of llama-server replicas with MODEL_THREADS threads each,
+# pinned to their own cores, so a many-core host is not bottlenecked on one process.
+# The worker and http-server balance requests across the pool (see endpoints.py).
+NPROC=$(nproc)
+MODEL_THREADS=${MODEL_THREADS:-2}
+DEFAULT_REPLICAS=$(( NPROC / (3 * MODEL_THREADS) ))
+if (( DEFAULT_REPLICAS < 1 )); then DEFAULT_REPLICAS=1; fi
+LLAMA_REPLICAS=${LLAMA_REPLICAS:-$DEFAULT_REPLICAS}
+EMBED_REPLICAS=${EMBED_REPLICAS:-$DEFAULT_REPLICAS}
+RERANK_REPLICAS=${RERANK_REPLICAS:-$DEFAULT_REPLICAS}
+NEXT_CORE=0
+
+# start_replicas <service> <replicas> <base port> <url path> <llama-server args>
+# Replica i listens on base port + 100*i; their URLs are collected in REPLICA_URLS.
+start_replicas() {
+    local service="$1" replicas="$2" base_port="$3" path="$4" args="$5"
+    REPLICA_URLS=""
+    for i in $(seq 0 $((replicas - 1))); do
+        local port=$((base_port + 100 * i))
+        local name="$service"
+        if (( i > 0 )); then name="${service}-$((i + 1))"; fi
+        local pinning=""
+        if (( NEXT_CORE + MODEL_THREADS <= NPROC )); then
+            pinning="--cpu-range $NEXT_CORE-$((NEXT_CORE + MODEL_THREADS - 1)) --cpu-strict 1"
+            NEXT_CORE=$((NEXT_CORE + MODEL_THREADS))
+        fi
+        box start_service "$name" "/usr/local/bin/llama-server $args --port $port -t $MODEL_THREADS $pinning" "$MODEL_DIR"
+        box check_health "http://localhost:$port/health" '"status":"ok"'
+        REPLICA_URLS="${REPLICA_URLS:+$REPLICA_URLS,}http://localhost:$port$path"
+    done
+}
+
 box print_header "5. Setup llama-server"
-LLAMA_CMD="/usr/local/bin/llama-server -m $HOME/$MODEL_DIR/Gemma3-1b.gguf --cpu-strict 1 --host 0.0.0.0 -t 2 --no-webui --top-k 2 --n_predict 256"
-box start_service "llama-server" "$LLAMA_CMD" "$MODEL_DIR"
-box check_health "http://localhost:8080/health" '"status":"ok"'
+start_replicas "llama-server" "$LLAMA_REPLICAS" 8080 "/completion" \
+    "-m $HOME/$MODEL_DIR/Gemma3-1b.gguf --host 0.0.0.0 --no-webui --top-k 2 --n_predict 256"
+LLAMA_SERVERS=$REPLICA_URLS
 
-# 5.2 Create and start embed-server service
+# 5.2 Create and start embed-server services
 box print_header "5.2 Setup embed-server"
-EMBED_CMD="/usr/local/bin/llama-server --embedding --port 8000 -ngl 99 -m $HOME/$MODEL_DIR/nomic-embed-text-v1.5.gguf -c 8192 -b 8192 --rope-scaling yarn --rope-freq-scale .75 --host 0.0.0.0"
-box start_service "embed-server" "$EMBED_CMD" "$MODEL_DIR"
-box check_health "http://localhost:8000/health" '"status":"ok"'
+start_replicas "embed-server" "$EMBED_REPLICAS" 8000 "/embedding" \
+    "--embedding -ngl 99 -m $HOME/$MODEL_DIR/nomic-embed-text-v1.5.gguf -c 8192 -b 8192 --rope-scaling yarn --rope-freq-scale .75 --host 0.0.0.0"
+EMBEDDING_SERVERS=$REPLICA_URLS
 
-# 5.3 Create and start rerank-server service
+# 5.3 Create and start rerank-server services
 box print_header "5.3 Setup rerank-server"
-EMBED_CMD="/usr/local/bin/llama-server -m models/bge-reranker-v2-m3-Q2_K.gguf --port 8008 --host 0.0.0.0 --reranking"
-box start_service "rerank-server" "$EMBED_CMD" "$MODEL_DIR"
-box check_health "http://localhost:8008/health" '"status":"ok"'
+start_replicas "rerank-server" "$RERANK_REPLICAS" 8008 "/rerank" \
+    "-m $HOME/$MODEL_DIR/bge-reranker-v2-m3-Q2_K.gguf --host 0.0.0.0 --reranking"
+RERANK_SERVERS=$REPLICA_URLS
+
+# Python services find the replica pools through these variables
+MODEL_ENV="/usr/bin/env EMBEDDING_SERVERS=$EMBEDDING_SERVERS RERANK_SERVERS=$RERANK_SERVERS LLAMA_SERVERS=$LLAMA_SERVERS"
 
 # 6. Download and Configure Redis Worker
 box print_header "6. Setup Redis Worker"
@@ -148,28 +183,63 @@ mkdir -p "$HTTP_DIR"
 cd "$HTTP_DIR"
 box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/heads/master/scripts/worker.py" "worker.py"
 box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/heads/master/scripts/helper.py" "helper.py"
+box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/heads/master/scripts/tiering.py" "tiering.py"
+box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/heads/master/scripts/vector_store.py" "vector_store.py"
+box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/heads/master/scripts/ingest_log.py" "ingest_log.py"
+box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/heads/master/scripts/endpoints.py" "endpoints.py"
+box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/heads/master/scripts/reembed.py" "reembed.py"
 
 chmod +x worker.py
 chmod +x helper.py
+chmod +x tiering.py
+chmod +x vector_store.py
+chmod +x ingest_log.py
+chmod +x endpoints.py
+chmod +x reembed.py
 cd $HOME
 
 box setup_venv
 
-WORKER_CMD="$HOME/$VENV_DIR/bin/rq worker -u redis://localhost:6379 snippet_queue"
-if [[ "$VIRT" != "wsl" ]]; then
-    nohup $WORKER_CMD > worker.log 2>&1 &
-else
-    box log_info "Creating systemd service for Redis worker..."
-    box start_service "redis-worker" "$WORKER_CMD" "$HTTP_DIR"
-fi
+# One worker pool per ingest stage. Extraction (spaCy) is CPU-bound and gets one
+# worker per core; Neo4j loads are serialized on the graph, so 1-2 workers suffice.
+# Each worker drains its fresh-capture queue before the backfill queue.
+EMBED_WORKERS=${EMBED_WORKERS:-2}
+EXTRACT_WORKERS=${EXTRACT_WORKERS:-$(nproc)}
+LOAD_WORKERS=${LOAD_WORKERS:-1}
+
+for STAGE in embed extract load; do
+    case "$STAGE" in
+        embed) WORKERS=$EMBED_WORKERS ;;
+        extract) WORKERS=$EXTRACT_WORKERS ;;
+        load) WORKERS=$LOAD_WORKERS ;;
+    esac
+    # worker.py warms up the stage (index check, spaCy import) once before forking jobs
+    WORKER_CMD="$MODEL_ENV $HOME/$VENV_DIR/bin/python $HOME/$HTTP_DIR/worker.py $STAGE"
+    for i in $(seq 1 "$WORKERS"); do
+        if [[ "$VIRT" != "wsl" ]]; then
+            nohup $WORKER_CMD > "worker-${STAGE}-${i}.log" 2>&1 &
+        else
+            box log_info "Creating systemd service for Redis worker ${STAGE}-${i}..."
+            box start_service "redis-worker-${STAGE}-${i}" "$WORKER_CMD" "$HTTP_DIR"
+        fi
+    done
+done
 
 sleep 5
-if "$HOME/$VENV_DIR/bin/rq" info --url redis://localhost:6379 | grep -q "snippet_queue"; then
-    echo "✅ Redis worker is healthy."
-else
-    echo "❌ Error: Redis worker health check failed."
-    exit 1
-fi
+for QUEUE in embed_queue extract_queue load_queue; do
+    if "$HOME/$VENV_DIR/bin/rq" info --url redis://localhost:6379 | grep -q "$QUEUE"; then
+        echo "✅ Redis worker for $QUEUE is healthy."
+    else
+        echo "❌ Error: Redis worker health check failed for $QUEUE."
+        exit 1
+    fi
+done
+
+# 6.2 Document tiering: move cold documents out of Redis into the on-disk archive
+# HOT_HORIZON_DAYS and REDIS_MEMORY_BUDGET_MB (see tiering.py) control what is evicted.
+box print_header "6.2 Setup document tiering"
+TIERING_CMD="$HOME/$VENV_DIR/bin/python $HOME/$HTTP_DIR/tiering.py --interval 3600"
+box start_service "tiering" "$TIERING_CMD" "$HTTP_DIR"
 
 # 7. Download and Configure http-server
 box print_header "7. Setup http-server"
@@ -178,7 +248,7 @@ box download_file "https://raw.githubusercontent.com/rajatasusual/llamabox/refs/
 chmod +x http-server.py
 cd $HOME
 
-HTTP_CMD="$HOME/$VENV_DIR/bin/python $HOME/$HTTP_DIR/http-server.py"
+HTTP_CMD="$MODEL_ENV $HOME/$VENV_DIR/bin/python $HOME/$HTTP_DIR/http-server.py"
 if [[ "$VIRT" != "wsl" ]]; then
     nohup $HTTP_CMD > http-server.log 2>&1 &
 else
@@ -187,6 +257,11 @@ else
 fi
 box check_health "http://localhost:5000/health" '"status":"ok"'
 
+# Delete ingest log segments past the replay window (INGEST_RETENTION_HOURS) once their
+# captures are indexed. Started like the http-server so both resolve INGEST_LOG_DIR alike.
+INGEST_PRUNE_CMD="$HOME/$VENV_DIR/bin/python $HOME/$HTTP_DIR/ingest_log.py prune --interval 3600"
+box start_service "ingest-prune" "$INGEST_PRUNE_CMD" "$HTTP_DIR"
+
 # 8. (WSL Only) Configure auto-restart, security, and additional settings
 if [[ "$VIRT" == "wsl" ]]; then
     box print_header "8. WSL-specific Configuration"